@@ -8,13 +8,33 @@ import requests
 import re
 import unicodedata
 import uuid
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+import tempfile
+import csv
+import io
+import zlib
+from urllib.parse import quote
 from io import BytesIO
-from flask import send_file
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher
+from flask import send_file, Response, stream_with_context
 import pandas as pd
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+from PIL import Image, ImageChops, ImageOps, ImageStat
 import ollama
+import httpx
 
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, desc, or_
+from sqlalchemy import func, desc, or_, case, insert, literal, select, update, event, text
+from sqlalchemy.exc import OperationalError
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -24,7 +44,10 @@ from flask_login import (
     current_user,
 )
 
-from models import db, Student, Violation, ViolationType, Teacher, SystemConfig, ClassRoom, WeeklyArchive, Subject, Grade, ChatConversation
+from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.exc import IntegrityError
+from models import db, Student, Violation, ViolationType, Teacher, SystemConfig, ClassRoom, WeeklyArchive, Subject, Grade, SubjectAverage, ChatConversation, BackgroundJob, ViolationWeek, OcrCache, LlmCache
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -39,6 +62,15 @@ app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 # Ollama Configuration
 OLLAMA_MODEL = "gemini-3-flash-preview:cloud"
 OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+# Số request vision (OCR) gửi đồng thời tới Ollama
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_MAX_CONCURRENCY", "4"))
+# Timeout (giây), retry và circuit breaker khi gọi Ollama
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "60"))
+OLLAMA_MAX_RETRIES = int(os.environ.get("OLLAMA_MAX_RETRIES", "2"))
+OLLAMA_RETRY_BACKOFF = 0.5  # Nhân đôi sau mỗi lần thử lại
+OLLAMA_BREAKER_THRESHOLD = 3  # Số lần gọi lỗi liên tiếp thì ngắt
+OLLAMA_BREAKER_COOLDOWN = 30  # Thời gian ngắt trước khi cho một request thử lại
 
 db.init_app(app)
 login_manager = LoginManager()
@@ -55,12 +87,51 @@ if not os.path.exists(UPLOAD_FOLDER):
 def load_user(user_id):
     return db.session.get(Teacher, int(user_id))
 
+# === GLOBAL TEMPLATE CONTEXT CACHE ===
+
+# Tuần hiện tại + danh sách lớp dùng trên mọi trang, cache trong bộ nhớ.
+# invalidate_global_context(): đổi/chuyển tuần, thêm/sửa/xóa lớp, import học sinh
+GLOBAL_CONTEXT_CACHE_TTL = 60
+_global_context_cache = {"data": None, "loaded_at": 0}
+_global_context_stats = {"hits": 0, "misses": 0}
+_global_context_lock = threading.Lock()
+
+def get_global_context():
+    """
+    Lấy tuần hiện tại và danh sách lớp (có cache)
+    
+    Returns:
+        dict: {"current_week": int, "classes": list[str]}
+    """
+    now = time.time()
+    with _global_context_lock:
+        data = _global_context_cache["data"]
+        if data is not None and now - _global_context_cache["loaded_at"] < GLOBAL_CONTEXT_CACHE_TTL:
+            _global_context_stats["hits"] += 1
+            return data
+        _global_context_stats["misses"] += 1
+    
+    week_cfg = SystemConfig.query.filter_by(key="current_week").first()
+    data = {
+        "current_week": int(week_cfg.value) if week_cfg else 1,
+        "classes": [c.name for c in ClassRoom.query.order_by(ClassRoom.name).all()]
+    }
+    with _global_context_lock:
+        _global_context_cache["data"] = data
+        _global_context_cache["loaded_at"] = now
+    return data
+
+def invalidate_global_context():
+    """Xóa cache tuần hiện tại / danh sách lớp (gọi sau khi commit)"""
+    with _global_context_lock:
+        _global_context_cache["data"] = None
+
 @app.context_processor
 def inject_global_data():
     try:
-        week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week = int(week_cfg.value) if week_cfg else 1
-        classes = [c.name for c in ClassRoom.query.order_by(ClassRoom.name).all()]
+        data = get_global_context()
+        current_week = data["current_week"]
+        classes = data["classes"]
     except:
         current_week = 1
         classes = []
@@ -75,30 +146,138 @@ def get_current_iso_week():
 def format_date_vn(date_obj):
     return date_obj.strftime('%d/%m')
 
-def save_weekly_archive(week_num):
+def save_weekly_archive(week_num, commit=True):
+    """
+    Lưu điểm cuối tuần của toàn bộ học sinh vào WeeklyArchive
+    Dùng một câu INSERT ... SELECT (join học sinh với tổng điểm trừ trong tuần),
+    chạy lại nhiều lần cho cùng một tuần vẫn cho cùng kết quả
+    
+    Args:
+        commit (bool): False - chỉ ghi vào transaction hiện tại, nơi gọi tự commit (lỗi được raise)
+    
+    Returns:
+        dict: {"rows": số dòng đã ghi, "seconds": thời gian chạy} hoặc None nếu lỗi
+    """
+    started = time.perf_counter()
     try:
         WeeklyArchive.query.filter_by(week_number=week_num).delete()
-        students = Student.query.all()
-        for s in students:
-            deductions = db.session.query(func.sum(Violation.points_deducted))\
-                .filter(Violation.student_id == s.id, Violation.week_number == week_num)\
-                .scalar() or 0
-            archive = WeeklyArchive(
-                week_number=week_num, student_id=s.id, student_name=s.name,
-                student_code=s.student_code, student_class=s.student_class,
-                final_score=s.current_score, total_deductions=deductions
-            )
-            db.session.add(archive)
-        db.session.commit()
-        return True
+        
+        deductions = db.session.query(
+            Violation.student_id.label("student_id"),
+            func.sum(Violation.points_deducted).label("total")
+        ).filter(Violation.week_number == week_num).group_by(Violation.student_id).subquery()
+        
+        rows = select(
+            literal(week_num),
+            Student.id,
+            Student.name,
+            Student.student_code,
+            Student.student_class,
+            Student.current_score,
+            func.coalesce(deductions.c.total, 0),
+            literal(datetime.datetime.utcnow())
+        ).select_from(Student).outerjoin(deductions, deductions.c.student_id == Student.id)
+        
+        result = db.session.execute(insert(WeeklyArchive).from_select(
+            ["week_number", "student_id", "student_name", "student_code", "student_class",
+             "final_score", "total_deductions", "created_at"],
+            rows
+        ))
+        if commit:
+            db.session.commit()
+            invalidate_class_stats(week=week_num)
+        
+        return {"rows": result.rowcount, "seconds": round(time.perf_counter() - started, 3)}
     except Exception as e:
+        if not commit:
+            raise
         print(f"Archive Error: {e}")
         db.session.rollback()
-        return False
+        return None
+
+def register_violation_weeks(weeks):
+    """Ghi nhận các tuần có vi phạm mới vào bảng ViolationWeek (gọi trước commit)"""
+    weeks = {int(w) for w in weeks if w is not None}
+    if not weeks:
+        return
+    # ON CONFLICT DO NOTHING: hai request cùng thêm tuần mới không bị IntegrityError
+    now = datetime.datetime.utcnow()
+    db.session.execute(
+        sqlite.insert(ViolationWeek)
+        .values([{"week_number": w, "created_at": now} for w in weeks])
+        .on_conflict_do_nothing(index_elements=["week_number"])
+    )
+
+def prune_violation_weeks(weeks):
+    """Xóa khỏi ViolationWeek các tuần không còn vi phạm nào (gọi sau khi xóa vi phạm, trước commit)"""
+    weeks = {int(w) for w in weeks if w is not None}
+    if not weeks:
+        return
+    still_used = select(Violation.week_number).where(Violation.week_number.in_(weeks))
+    ViolationWeek.query.filter(
+        ViolationWeek.week_number.in_(weeks),
+        ViolationWeek.week_number.not_in(still_used)
+    ).delete(synchronize_session=False)
+
+def seed_violation_weeks():
+    """Bổ sung vào ViolationWeek mọi tuần đã có trong bảng Violation (idempotent, chạy khi khởi động)"""
+    known = select(ViolationWeek.week_number)
+    weeks = select(
+        Violation.week_number,
+        literal(datetime.datetime.utcnow())
+    ).where(
+        Violation.week_number.isnot(None),
+        Violation.week_number.not_in(known)
+    ).distinct()
+    db.session.execute(insert(ViolationWeek).from_select(["week_number", "created_at"], weeks))
+    db.session.commit()
+
+def get_violation_weeks():
+    """Danh sách tuần có vi phạm, mới nhất trước (bảng được khởi tạo bởi seed_violation_weeks)"""
+    return [w for (w,) in db.session.query(ViolationWeek.week_number).order_by(ViolationWeek.week_number.desc())]
+
+def get_class_rankings(week):
+    """
+    Số liệu xếp hạng các lớp trong một tuần bằng 2 truy vấn GROUP BY
+    
+    Returns:
+        list[dict]: {"name", "archived_avg" (None nếu chưa lưu trữ), "weekly_deduct", "student_count"}
+    """
+    archived = {
+        cls: avg for cls, avg in db.session.query(
+            WeeklyArchive.student_class,
+            func.avg(WeeklyArchive.final_score)
+        ).filter(WeeklyArchive.week_number == week).group_by(WeeklyArchive.student_class)
+    }
+    
+    current = {
+        cls: (student_count, deduct) for cls, student_count, deduct in db.session.query(
+            Student.student_class,
+            func.count(func.distinct(Student.id)),
+            func.coalesce(func.sum(Violation.points_deducted), 0)
+        ).outerjoin(
+            Violation, (Violation.student_id == Student.id) & (Violation.week_number == week)
+        ).group_by(Student.student_class)
+    }
+    
+    rankings = []
+    for cls_name in get_global_context()["classes"]:
+        student_count, deduct = current.get(cls_name, (0, 0))
+        rankings.append({
+            "name": cls_name,
+            "archived_avg": archived.get(cls_name),
+            "weekly_deduct": deduct,
+            "student_count": student_count
+        })
+    return rankings
 
 def is_reset_needed():
     """Kiểm tra xem đã sang tuần thực tế mới chưa để hiện cảnh báo"""
     try:
+        # Đang chuyển tuần ở nền -> hiển thị tiến độ thay vì cảnh báo
+        if get_active_job("week_rollover"):
+            return False
+        
         current_iso_week = get_current_iso_week()
         last_reset_cfg = SystemConfig.query.filter_by(key="last_reset_week_id").first()
         
@@ -113,6 +292,189 @@ def is_reset_needed():
         pass
     return False
 
+# === BACKGROUND JOB HELPER FUNCTIONS ===
+
+# Job "pending"/"running" không cập nhật quá thời gian này coi như đã chết (worker bị restart)
+JOB_STALE_SECONDS = 600
+JOB_WORKERS = 2
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+# Pool riêng cho tác vụ AI (phân tích lớp, nhận xét học sinh) để model chậm không chiếm worker web
+# và không chặn job import/chuyển tuần
+AI_JOB_WORKERS = int(os.environ.get("AI_JOB_WORKERS", "2"))
+AI_JOB_TIMEOUT = int(os.environ.get("AI_JOB_TIMEOUT", "90"))
+_ai_executor = ThreadPoolExecutor(max_workers=AI_JOB_WORKERS, thread_name_prefix="ai")
+# Job đã xong/lỗi cũ hơn số ngày này bị xóa khi tạo job mới
+JOB_RETENTION_DAYS = int(os.environ.get("JOB_RETENTION_DAYS", "7"))
+# Job toàn hệ thống (dashboard của mọi giáo viên đều theo dõi), không giới hạn theo người tạo
+SHARED_JOB_TYPES = ("week_rollover",)
+
+def job_to_dict(job):
+    """Chuyển BackgroundJob thành dict để trả về API"""
+    return {
+        "id": job.id,
+        "job_type": job.job_type,
+        "status": job.status,
+        "progress": job.progress or 0,
+        "processed_rows": job.processed_rows or 0,
+        "error_count": job.error_count or 0,
+        "message": job.message,
+        "result": json.loads(job.result) if job.result else None,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "started_at": job.started_at.isoformat() if job.started_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "duration_seconds": round(((job.finished_at or datetime.datetime.utcnow()) - job.started_at).total_seconds(), 1) if job.started_at else None
+    }
+
+def get_active_job(job_type, created_by=None):
+    """Lấy job đang chờ/đang chạy (chưa quá hạn) của một loại (và của một giáo viên nếu có), None nếu không có"""
+    stale_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=JOB_STALE_SECONDS)
+    query = BackgroundJob.query.filter(
+        BackgroundJob.job_type == job_type,
+        BackgroundJob.status.in_(["pending", "running"]),
+        BackgroundJob.updated_at >= stale_before
+    )
+    if created_by is not None:
+        query = query.filter(BackgroundJob.created_by == created_by)
+    return query.order_by(BackgroundJob.id.desc()).first()
+
+def update_job(job_id, **fields):
+    """Cập nhật trạng thái/tiến độ job và commit ngay để request khác đọc được"""
+    job = db.session.get(BackgroundJob, job_id)
+    if not job:
+        return
+    for key, value in fields.items():
+        setattr(job, key, value)
+    job.updated_at = datetime.datetime.utcnow()
+    db.session.commit()
+
+def check_job_timeout(job):
+    """
+    Đánh dấu failed cho job quá hạn:
+    - đang chạy quá params["timeout"] giây (tính từ lúc bắt đầu chạy)
+    - còn pending quá JOB_STALE_SECONDS kể từ lúc tạo (executor mất job khi server restart)
+    - đang chạy nhưng không cập nhật tiến độ quá JOB_STALE_SECONDS (worker bị restart)
+    
+    Returns:
+        BackgroundJob: job với trạng thái mới nhất
+    """
+    if job.status not in ("pending", "running"):
+        return job
+    now = datetime.datetime.utcnow()
+    timeout = json.loads(job.params).get("timeout") if job.params else None
+    error = None
+    if job.status == "pending":
+        if job.created_at and (now - job.created_at).total_seconds() > JOB_STALE_SECONDS:
+            error = "Job không được xử lý (server có thể đã khởi động lại)"
+    elif timeout and job.started_at and (now - job.started_at).total_seconds() > timeout:
+        error = f"Quá thời gian xử lý ({timeout} giây)"
+    elif job.updated_at and (now - job.updated_at).total_seconds() > JOB_STALE_SECONDS:
+        error = "Job bị gián đoạn (server có thể đã khởi động lại)"
+    if error:
+        update_job(job.id, status="failed", error=error, finished_at=now)
+    return job
+
+def _run_job(job_id, func, params):
+    """Chạy job trong thread của executor (có app context riêng)"""
+    with app.app_context():
+        try:
+            job = db.session.get(BackgroundJob, job_id)
+            if not job or job.status != "pending":
+                return  # Đã bị đánh dấu quá hạn khi còn chờ trong hàng đợi
+            update_job(job_id, status="running", started_at=datetime.datetime.utcnow())
+            result = func(job_id, params)
+            job = db.session.get(BackgroundJob, job_id)
+            db.session.refresh(job)
+            if check_job_timeout(job).status != "running":
+                return  # Đã bị đánh dấu quá thời gian, không ghi đè kết quả
+            update_job(
+                job_id, status="done", progress=100,
+                result=json.dumps(result, ensure_ascii=False, default=str),
+                finished_at=datetime.datetime.utcnow()
+            )
+        except Exception as e:
+            print(f"Job {job_id} Error: {e}")
+            db.session.rollback()
+            update_job(job_id, status="failed", error=str(e), finished_at=datetime.datetime.utcnow())
+        finally:
+            db.session.remove()
+
+def prune_finished_jobs():
+    """
+    Xóa các job đã xong/lỗi quá JOB_RETENTION_DAYS ngày (không commit)
+    
+    Returns:
+        int: Số job đã xóa
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=JOB_RETENTION_DAYS)
+    return BackgroundJob.query.filter(
+        BackgroundJob.status.in_(["done", "failed"]),
+        BackgroundJob.finished_at < cutoff
+    ).delete(synchronize_session=False)
+
+def create_job(job_type, params=None, created_by=None, timeout=None):
+    """
+    Tạo bản ghi BackgroundJob (status = pending)
+    
+    Args:
+        timeout (int, optional): Số giây tối đa job được chạy, lưu trong params["timeout"]
+    
+    Returns:
+        BackgroundJob: job vừa tạo
+    """
+    if timeout:
+        params = dict(params or {}, timeout=timeout)
+    job = BackgroundJob(
+        job_type=job_type,
+        status="pending",
+        params=json.dumps(params, ensure_ascii=False) if params else None,
+        created_by=created_by
+    )
+    prune_finished_jobs()
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def submit_job(job_type, func, params=None, created_by=None):
+    """
+    Tạo bản ghi BackgroundJob và đưa func(job_id, params) vào thread pool
+    
+    Returns:
+        BackgroundJob: job vừa tạo (status = pending)
+    """
+    job = create_job(job_type, params, created_by)
+    _job_executor.submit(_run_job, job.id, func, params or {})
+    return job
+
+def respond_ai_job(job_type, func, params, wait=True):
+    """
+    Chạy tác vụ AI trên _ai_executor (giới hạn AI_JOB_TIMEOUT giây)
+    
+    Args:
+        wait (bool): True - chờ kết quả rồi trả về như endpoint đồng bộ;
+            False - trả 202 + job_id ngay để client theo dõi qua /api/jobs/<job_id>
+    
+    Returns:
+        Response: kết quả job (200), lỗi (500), job_id (202) hoặc 504 nếu chờ quá lâu
+    """
+    job = create_job(job_type, params, created_by=current_user.id, timeout=AI_JOB_TIMEOUT)
+    future = _ai_executor.submit(_run_job, job.id, func, json.loads(job.params))
+    if not wait:
+        return jsonify({"job_id": job.id, "status": job.status, "timeout": AI_JOB_TIMEOUT}), 202
+    
+    try:
+        future.result(timeout=AI_JOB_TIMEOUT)
+    except FutureTimeoutError:
+        pass
+    # Job được cập nhật trong thread khác: đọc lại trạng thái mới nhất
+    db.session.refresh(job)
+    check_job_timeout(job)
+    if job.status == "done":
+        return jsonify(json.loads(job.result))
+    if job.status == "failed":
+        return jsonify({"error": job.error, "job_id": job.id}), 500
+    return jsonify({"error": "AI đang bận, vui lòng thử lại sau.", "job_id": job.id}), 504
+
 # === CHATBOT MEMORY HELPER FUNCTIONS ===
 
 def get_or_create_chat_session():
@@ -166,6 +528,68 @@ def save_message(session_id, teacher_id, role, message, context_data=None):
     db.session.add(chat_msg)
     db.session.commit()
 
+# Ghi chú nối vào câu trả lời AI bị ngắt giữa chừng
+CHATBOT_TRUNCATED_NOTE = "_(Câu trả lời bị gián đoạn do mất kết nối với AI, có thể chưa đầy đủ.)_"
+
+def sse_event(payload):
+    """Đóng gói một sự kiện Server-Sent Events (JSON)"""
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def stream_chat_response(prompt, session_id, teacher_id, fallback_text, buttons=None, context_data=None):
+    """
+    Trả lời chatbot dạng SSE: chuyển tiếp từng đoạn text ngay khi model sinh ra
+    
+    Sự kiện gửi về client:
+        {"delta": str}  - đoạn text mới
+        {"done": true, "buttons": [...], "response"?: str}  - kết thúc; có "response" khi AI lỗi
+            (client hiển thị nội dung này thay cho các đoạn đã nhận): nội dung fallback nếu chưa
+            sinh được chữ nào, hoặc phần đã sinh kèm ghi chú bị gián đoạn
+    
+    Tin nhắn của trợ lý được lưu bằng save_message sau khi stream kết thúc. Câu trả lời bị
+    gián đoạn được lưu kèm ghi chú và context_data["truncated"] để lượt sau không coi là đầy đủ.
+    
+    Args:
+        prompt (str): Prompt gửi AI
+        session_id (str): ID của chat session
+        teacher_id (int): ID của teacher
+        fallback_text (str): Nội dung trả lời khi AI không phản hồi
+        buttons (list, optional): Các nút hành động gửi kèm khi kết thúc
+        context_data (dict, optional): Metadata lưu cùng câu trả lời của AI
+    
+    Returns:
+        Response: text/event-stream
+    """
+    def generate():
+        parts = []
+        failed = False
+        try:
+            for piece in _stream_gemini(prompt):
+                if piece:
+                    parts.append(piece)
+                    yield sse_event({"delta": piece})
+        except Exception as e:
+            print(f"Chatbot Stream Error: {e}")
+            failed = True
+        
+        text = "".join(parts).strip()
+        if text and failed:
+            text += f"\n\n{CHATBOT_TRUNCATED_NOTE}"
+            save_message(session_id, teacher_id, "assistant", text,
+                         context_data=dict(context_data or {}, truncated=True))
+            yield sse_event({"done": True, "response": text, "buttons": buttons or []})
+        elif text:
+            save_message(session_id, teacher_id, "assistant", text, context_data=context_data)
+            yield sse_event({"done": True, "buttons": buttons or []})
+        else:
+            save_message(session_id, teacher_id, "assistant", fallback_text)
+            yield sse_event({"done": True, "response": fallback_text.strip(), "buttons": buttons or []})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # Context-aware AI System Prompt
 CHATBOT_SYSTEM_PROMPT = """Vai trò: Bạn là một Trợ lý AI có Nhận thức Ngữ cảnh Cao (Context-Aware AI Assistant) cho giáo viên chủ nhiệm.
 
@@ -196,9 +620,159 @@ def calculate_week_from_date(date_obj):
     _, week_num, _ = date_obj.isocalendar()
     return week_num
 
-def parse_excel_file(file):
+# Các định dạng ngày được chấp nhận, thử lần lượt theo thứ tự
+EXCEL_DATE_FORMATS = ['%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y %H:%M']
+
+def parse_excel_dates(values):
+    """
+    Chuyển cột ngày sang datetime (vectorized): thử từng định dạng rồi gộp kết quả,
+    cuối cùng thử phần ngày YYYY-MM-DD. Giá trị không đọc được trả về NaT
+    
+    Args:
+        values: pandas Series
+    
+    Returns:
+        pandas Series (datetime64)
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    
+    text = values.astype(str).str.strip()
+    dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in EXCEL_DATE_FORMATS:
+        dates = dates.fillna(pd.to_datetime(text, format=fmt, errors='coerce'))
+    dates = dates.fillna(pd.to_datetime(text.str.split().str[0], format='%Y-%m-%d', errors='coerce'))
+    return dates
+
+# Số dòng đọc từ file Excel mỗi lần (chế độ read-only của openpyxl)
+EXCEL_READ_BATCH_SIZE = 5000
+# Dừng import khi số lỗi đạt ngưỡng này
+IMPORT_MAX_ERRORS = 200
+
+VIOLATION_REQUIRED_COLUMNS = ['Mã học sinh', 'Loại vi phạm', 'Điểm trừ', 'Ngày vi phạm']
+
+def iter_excel_frames(file, batch_size=EXCEL_READ_BATCH_SIZE, stats=None):
+    """
+    Đọc sheet đầu tiên theo từng lô dòng bằng openpyxl read-only, bộ nhớ không phụ thuộc kích thước file
+    File .xls (định dạng cũ) không hỗ trợ read-only nên được đọc một lần bằng pandas
+    
+    Args:
+        file: file upload, đường dẫn file hoặc file-like object
+        batch_size: số dòng mỗi lô
+        stats: dict, nếu có thì ghi stats['total'] = số dòng dữ liệu ước tính (theo kích thước sheet)
+    
+    Yields:
+        pandas DataFrame: index là vị trí dòng dữ liệu (0 = dòng ngay sau tiêu đề)
+    """
+    stats = {} if stats is None else stats
+    filename = file if isinstance(file, str) else getattr(file, 'filename', '')
+    if str(filename or '').lower().endswith('.xls'):
+        df = pd.read_excel(file)
+        stats['total'] = len(df)
+        yield df
+        return
+    
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        if ws.max_row:
+            stats['total'] = max(ws.max_row - 1, 0)
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(c).strip() if c is not None else f"Unnamed: {i}" for i, c in enumerate(header)]
+        
+        offset = 0
+        yielded = False
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            # Bỏ dòng trống hoàn toàn nhưng giữ nguyên số thứ tự dòng
+            index = [offset + i for i, r in enumerate(batch) if any(v is not None for v in r)]
+            data = [batch[i - offset][:len(columns)] for i in index]
+            offset += len(batch)
+            if data:
+                yielded = True
+                yield pd.DataFrame(data, columns=columns[:max(len(r) for r in data)], index=index).reindex(columns=columns)
+        
+        # File chỉ có tiêu đề: vẫn trả về khung rỗng để kiểm tra cột
+        if not yielded:
+            yield pd.DataFrame(columns=columns)
+    finally:
+        wb.close()
+
+def validate_violation_frame(df):
+    """
+    Kiểm tra và chuyển đổi một lô dòng vi phạm (vectorized)
+    Dòng không hợp lệ được loại ra và ghi lỗi thay vì làm hỏng cả file
+    
+    Args:
+        df: DataFrame đã có đủ cột bắt buộc, index là vị trí dòng dữ liệu
+    
+    Returns:
+        Tuple[List[dict], List[dict]]: (violations data, row errors {'row_number', 'error'}), đều theo thứ tự dòng
+    """
+    # Dòng 1 là tiêu đề
+    row_numbers = pd.Series(df.index + 2, index=df.index)
+    
+    codes = df['Mã học sinh'].astype(str).str.strip()
+    types = df['Loại vi phạm'].astype(str).str.strip()
+    points = pd.to_numeric(df['Điểm trừ'], errors='coerce')
+    dates = parse_excel_dates(df['Ngày vi phạm'])
+    
+    # Tuần: lấy từ file nếu có, nếu trống thì tính theo tuần ISO của ngày vi phạm
+    week_raw = df['Tuần'] if 'Tuần' in df.columns else pd.Series(None, index=df.index, dtype=float)
+    weeks = pd.to_numeric(week_raw, errors='coerce')
+    weeks = weeks.fillna(dates.dt.isocalendar().week.astype(float).where(week_raw.isna()))
+    
+    checks = [
+        (df['Mã học sinh'].isna() | (codes == ''), lambda i: "Thiếu mã học sinh"),
+        (df['Loại vi phạm'].isna() | (types == ''), lambda i: "Thiếu loại vi phạm"),
+        (points.isna(), lambda i: f"Điểm trừ không hợp lệ: {df.at[i, 'Điểm trừ']}"),
+        (dates.isna(), lambda i: f"Định dạng ngày không hợp lệ: {df.at[i, 'Ngày vi phạm']}"),
+        (dates.notna() & weeks.isna(), lambda i: f"Tuần không hợp lệ: {week_raw.at[i]}"),
+    ]
+    
+    invalid = pd.Series(False, index=df.index)
+    row_errors = {}
+    for mask, message in checks:
+        for i in df.index[mask & ~invalid]:
+            row_errors[i] = f"Dòng {row_numbers.at[i]}: {message(i)}"
+        invalid |= mask
+    errors = [{'row_number': row_numbers.at[i], 'error': row_errors[i]} for i in sorted(row_errors)]
+    
+    valid = ~invalid
+    points = pd.to_numeric(points[valid].astype(int), downcast='integer')
+    weeks = pd.to_numeric(weeks[valid].astype(int), downcast='integer')
+    
+    violations = [
+        {
+            'row_number': row_number,
+            'student_code': code,
+            'violation_type_name': type_name,
+            'points_deducted': pts,
+            'date_committed': date_committed,
+            'week_number': week_number
+        }
+        for row_number, code, type_name, pts, date_committed, week_number in zip(
+            row_numbers[valid].tolist(),
+            codes[valid].tolist(),
+            types[valid].tolist(),
+            points.tolist(),
+            dates[valid].dt.to_pydatetime().tolist(),
+            weeks.tolist()
+        )
+    ]
+    
+    return violations, errors
+
+def iter_excel_violations(file, stats=None, batch_size=EXCEL_READ_BATCH_SIZE):
     """
-    Parse Excel file using pandas
+    Đọc file Excel vi phạm theo luồng: mỗi lô được kiểm tra rồi trả ra ngay cho bước import
+    Dòng không hợp lệ được trả ra dưới dạng {'row_number', 'error'} đúng vị trí của nó, nên bước
+    import thấy lỗi theo đúng thứ tự dòng và chỉ những dòng đã tiêu thụ mới được tính
     
     Expected columns:
     - Mã học sinh (student_code)
@@ -207,108 +781,597 @@ def parse_excel_file(file):
     - Ngày vi phạm (date_committed) - format: YYYY-MM-DD HH:MM or DD/MM/YYYY HH:MM
     - Tuần (week_number) - optional, auto-calculate if empty
     
-    Returns:
-        List[dict]: Violations data
+    Args:
+        file: file upload
+        stats: dict, cập nhật stats['total'] = tổng số dòng dữ liệu (nếu biết trước)
+    
+    Yields:
+        dict: violation data hoặc lỗi dòng {'row_number', 'error'} ('row_number' là số dòng trong Excel)
     """
     try:
-        df = pd.read_excel(file)
-        
-        # Validate required columns
-        required_cols = ['Mã học sinh', 'Loại vi phạm', 'Điểm trừ', 'Ngày vi phạm']
-        for col in required_cols:
-            if col not in df.columns:
-                raise ValueError(f"Thiếu cột bắt buộc: {col}")
-        
-        violations = []
-        for idx, row in df.iterrows():
-            # Parse datetime
-            date_str = str(row['Ngày vi phạm'])
-            try:
-                # Try YYYY-MM-DD HH:MM format
-                date_committed = datetime.datetime.strptime(date_str, '%Y-%m-%d %H:%M')
-            except:
-                try:
-                    # Try DD/MM/YYYY HH:MM format
-                    date_committed = datetime.datetime.strptime(date_str, '%d/%m/%Y %H:%M')
-                except:
-                    try:
-                        # Try date only YYYY-MM-DD
-                        date_committed = datetime.datetime.strptime(date_str.split()[0], '%Y-%m-%d')
-                    except:
-                        raise ValueError(f"Dòng {idx+2}: Định dạng ngày không hợp lệ: {date_str}")
-            
-            # Calculate week_number if not provided
-            week_number = row.get('Tuần', None)
-            if pd.isna(week_number):
-                week_number = calculate_week_from_date(date_committed)
-            
-            violations.append({
-                'student_code': str(row['Mã học sinh']).strip(),
-                'violation_type_name': str(row['Loại vi phạm']).strip(),
-                'points_deducted': int(row['Điểm trừ']),
-                'date_committed': date_committed,
-                'week_number': int(week_number)
-            })
-        
-        return violations
+        frames = iter_excel_frames(file, batch_size, stats)
+        first = next(frames, None)
     except Exception as e:
         raise ValueError(f"Lỗi đọc file Excel: {str(e)}")
+    if first is None:
+        return
+    
+    # Validate required columns (một lần)
+    for col in VIOLATION_REQUIRED_COLUMNS:
+        if col not in first.columns:
+            raise ValueError(f"Lỗi đọc file Excel: Thiếu cột bắt buộc: {col}")
+    
+    for df in itertools.chain([first], frames):
+        violations, frame_errors = validate_violation_frame(df)
+        yield from heapq.merge(violations, frame_errors, key=lambda v: v['row_number'])
+
+def parse_excel_file(file):
+    """
+    Parse toàn bộ file Excel vi phạm (xem iter_excel_violations)
+    
+    Returns:
+        Tuple[List[dict], List[str]]: (violations data, row errors)
+    """
+    violations, errors = [], []
+    for v in iter_excel_violations(file):
+        if 'error' in v:
+            errors.append(v['error'])
+        else:
+            violations.append(v)
+    return violations, errors
+
+# Số dòng ghi vào CSDL trong mỗi transaction khi import
+IMPORT_CHUNK_SIZE = 1000
+# Số mã học sinh trong mỗi truy vấn IN khi tra cứu (dưới giới hạn biến của SQLite)
+STUDENT_CODE_BATCH_SIZE = 500
+
+def resolve_student_codes(codes, code_map=None):
+    """
+    Tra cứu ID học sinh theo mã bằng truy vấn IN (chia lô), bỏ qua mã đã có trong code_map
+    
+    Returns:
+        dict: {student_code: student_id}
+    """
+    code_map = {} if code_map is None else code_map
+    missing = [c for c in set(codes) if c and c not in code_map]
+    for i in range(0, len(missing), STUDENT_CODE_BATCH_SIZE):
+        chunk = missing[i:i + STUDENT_CODE_BATCH_SIZE]
+        for student_id, code in db.session.query(Student.id, Student.student_code).filter(Student.student_code.in_(chunk)):
+            code_map[code] = student_id
+    return code_map
+
+def violation_content_hash(student_id, violation_type_name, date_committed, points_deducted):
+    """
+    Hash nội dung của một vi phạm, dùng làm khóa chống trùng khi import
+    
+    Returns:
+        str: sha256 hex của (student_id, loại vi phạm, thời điểm (đến giây), điểm trừ)
+    """
+    if isinstance(date_committed, datetime.datetime):
+        date_committed = date_committed.strftime('%Y-%m-%d %H:%M:%S')
+    key = f"{student_id}|{str(violation_type_name).strip()}|{date_committed}|{int(points_deducted)}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def ensure_violation_content_hash(rehash_missing=False):
+    """
+    Nâng cấp database cũ: thêm cột violation.content_hash, gán hash cho vi phạm cũ và tạo unique index
+    Nếu dữ liệu cũ đã có bản ghi trùng thì chỉ bản ghi đầu tiên được gán hash. Chạy lại nhiều lần vẫn an toàn
+    
+    Args:
+        rehash_missing (bool): Quét lại các vi phạm chưa có hash kể cả khi cột đã tồn tại
+            (mặc định chỉ gán hash ngay khi vừa thêm cột, để lần khởi động sau không phải quét lại)
+    
+    Returns:
+        int: số vi phạm cũ vừa được gán hash (0 nếu database đã được nâng cấp)
+    """
+    columns = {row[1] for row in db.session.execute(text("PRAGMA table_info(violation)"))}
+    assigned = 0
+    if 'content_hash' not in columns:
+        db.session.execute(text("ALTER TABLE violation ADD COLUMN content_hash VARCHAR(64)"))
+    
+    if 'content_hash' not in columns or rehash_missing:
+        # Hash đã có (khi chạy lại) cũng phải được tính để không vi phạm unique index
+        seen = set(db.session.scalars(
+            select(Violation.content_hash).where(Violation.content_hash.isnot(None))
+        ))
+        updates = []
+        rows = db.session.query(
+            Violation.id, Violation.student_id, Violation.violation_type_name,
+            Violation.date_committed, Violation.points_deducted
+        ).filter(Violation.content_hash.is_(None)).order_by(Violation.id)
+        for v_id, student_id, type_name, date_committed, points in rows:
+            h = violation_content_hash(student_id, type_name, date_committed, points)
+            if h not in seen:
+                seen.add(h)
+                updates.append({"id": v_id, "content_hash": h})
+        if updates:
+            db.session.execute(
+                text("UPDATE violation SET content_hash = :content_hash WHERE id = :id"), updates
+            )
+        assigned = len(updates)
+    
+    db.session.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_violation_content_hash ON violation (content_hash)"
+    ))
+    db.session.commit()
+    return assigned
 
-def import_violations_to_db(violations_data):
+def _insert_violation_chunk(mappings, errors, duplicates, dry_run=False):
+    """
+    Ghi một lô vi phạm bằng executemany trong một transaction
+    Nếu lô lỗi thì ghi lại từng dòng để xác định chính xác dòng nào hỏng (hoặc trùng do import song song)
+    
+    Args:
+        mappings: List[(row_number, dict cột Violation)]
+        errors: danh sách lỗi (được bổ sung)
+        duplicates: danh sách dòng trùng (được bổ sung)
+        dry_run: chạy thử - ghi rồi rollback để kiểm tra ràng buộc mà không lưu
+    
+    Returns:
+        int: số dòng đã ghi (hoặc sẽ ghi nếu dry_run)
+    """
+    if not mappings:
+        return 0
+    finish = db.session.rollback if dry_run else db.session.commit
+    try:
+        db.session.execute(insert(Violation), [m for _, m in mappings])
+        register_violation_weeks(m['week_number'] for _, m in mappings)
+        finish()
+        return len(mappings)
+    except Exception:
+        db.session.rollback()
+    
+    inserted = 0
+    for row_number, m in mappings:
+        try:
+            db.session.execute(insert(Violation), [m])
+            register_violation_weeks([m['week_number']])
+            finish()
+            inserted += 1
+        except IntegrityError as e:
+            db.session.rollback()
+            if 'content_hash' in str(e.orig):
+                duplicates.append(f"Dòng {row_number}: Vi phạm đã tồn tại")
+            else:
+                errors.append(f"Dòng {row_number}: Lỗi lưu database: {str(e)}")
+        except Exception as e:
+            db.session.rollback()
+            errors.append(f"Dòng {row_number}: Lỗi lưu database: {str(e)}")
+    return inserted
+
+@dataclass
+class ImportResult:
+    """Kết quả import_violations_to_db"""
+    errors: list = field(default_factory=list)
+    success_count: int = 0
+    chunks: list = field(default_factory=list)
+    duplicates: list = field(default_factory=list)
+    processed_rows: int = 0  # Số dòng đầu vào đã xử lý (đã ghi, trùng hoặc lỗi)
+    stopped: bool = False  # Dừng khi còn dòng chưa xử lý do số lỗi đạt max_errors
+
+def import_violations_to_db(violations_data, errors=None, max_errors=None, on_chunk=None, dry_run=False):
     """
     Import violations to database
+    Mã học sinh được tra cứu bằng truy vấn IN theo lô, dữ liệu được ghi theo từng lô
+    IMPORT_CHUNK_SIZE dòng (mỗi lô một transaction) nên một dòng lỗi không làm mất các lô khác
+    Dòng trùng (cùng content_hash với bản ghi đã có hoặc dòng trước trong file) được bỏ qua
+    và báo riêng, nên import lại cùng một file không tạo bản ghi trùng
     
     Args:
-        violations_data: List[dict] with keys:
+        violations_data: Iterable[dict] with keys:
             - student_code
             - violation_type_name
             - points_deducted
             - date_committed
             - week_number
+            hoặc {'row_number', 'error'} cho dòng đã lỗi khi đọc file (xem iter_excel_violations)
+        errors: danh sách lỗi sẵn có, lỗi import được nối tiếp vào
+        max_errors: dừng sau lô hiện tại khi tổng số lỗi đạt ngưỡng
+        on_chunk: hàm gọi sau mỗi lô với ImportResult tạm thời (VD: cập nhật tiến độ job)
+        dry_run: chỉ kiểm tra, trả về số dòng sẽ ghi/trùng/lỗi mà không lưu gì
     
     Returns:
-        Tuple[List[str], int]: (errors, success_count)
+        ImportResult: lỗi, số dòng đã ghi, báo cáo từng lô, dòng trùng, số dòng đã xử lý, cờ dừng sớm
     """
-    errors = []
-    success_count = 0
+    result = ImportResult(errors=[] if errors is None else errors)
+    errors = result.errors
+    duplicates = result.duplicates
+    chunks = result.chunks
+    code_map = {}
+    seen_hashes = set()
     
-    for idx, v_data in enumerate(violations_data):
-        try:
-            # Find student
-            student = Student.query.filter_by(student_code=v_data['student_code']).first()
-            if not student:
-                errors.append(f"Dòng {idx+1}: Không tìm thấy học sinh '{v_data['student_code']}'")
+    rows = enumerate(violations_data)
+    while True:
+        batch = list(itertools.islice(rows, IMPORT_CHUNK_SIZE))
+        if not batch:
+            break
+        result.processed_rows += len(batch)
+        
+        resolve_student_codes((str(v.get('student_code', '')).strip() for _, v in batch if 'error' not in v), code_map)
+        
+        errors_before = len(errors)
+        duplicates_before = len(duplicates)
+        mappings = []
+        for idx, v_data in batch:
+            if 'error' in v_data:
+                errors.append(v_data['error'])
                 continue
-            
-            # Create violation record
-            violation = Violation(
-                student_id=student.id,
-                violation_type_name=v_data['violation_type_name'],
-                points_deducted=v_data['points_deducted'],
-                date_committed=v_data['date_committed'],
-                week_number=v_data['week_number']
-            )
-            
-            db.session.add(violation)
-            
-            # QUAN TRỌNG: KHÔNG cập nhật current_score
-            # Chỉ lưu lịch sử, không ảnh hưởng điểm hiện tại
-            
-            success_count += 1
-            
-        except Exception as e:
-            errors.append(f"Dòng {idx+1}: {str(e)}")
-            db.session.rollback()
+            row_number = v_data.get('row_number', idx + 1)
+            try:
+                code = str(v_data['student_code']).strip()
+                student_id = code_map.get(code)
+                if not student_id:
+                    errors.append(f"Dòng {row_number}: Không tìm thấy học sinh '{v_data['student_code']}'")
+                    continue
+                
+                # QUAN TRỌNG: KHÔNG cập nhật current_score
+                # Chỉ lưu lịch sử, không ảnh hưởng điểm hiện tại
+                mappings.append((row_number, {
+                    'student_id': student_id,
+                    'violation_type_name': v_data['violation_type_name'],
+                    'points_deducted': int(v_data['points_deducted']),
+                    'date_committed': v_data['date_committed'],
+                    'week_number': int(v_data['week_number']),
+                    'content_hash': violation_content_hash(
+                        student_id, v_data['violation_type_name'],
+                        v_data['date_committed'], v_data['points_deducted']
+                    )
+                }))
+            except Exception as e:
+                errors.append(f"Dòng {row_number}: {str(e)}")
+        
+        # Bỏ dòng trùng: một truy vấn IN cho cả lô + set các hash đã gặp trong file
+        existing = set(db.session.scalars(
+            select(Violation.content_hash).where(Violation.content_hash.in_([m['content_hash'] for _, m in mappings]))
+        )) if mappings else set()
+        new_mappings = []
+        for row_number, m in mappings:
+            if m['content_hash'] in existing or m['content_hash'] in seen_hashes:
+                duplicates.append(f"Dòng {row_number}: Vi phạm đã tồn tại")
+                continue
+            seen_hashes.add(m['content_hash'])
+            new_mappings.append((row_number, m))
+        
+        inserted = _insert_violation_chunk(new_mappings, errors, duplicates, dry_run)
+        result.success_count += inserted
+        chunks.append({
+            "chunk": len(chunks) + 1,
+            "first_row": batch[0][1].get('row_number', batch[0][0] + 1),
+            "last_row": batch[-1][1].get('row_number', batch[-1][0] + 1),
+            "inserted": inserted,
+            "duplicates": len(duplicates) - duplicates_before,
+            "errors": len(errors) - errors_before
+        })
+        if on_chunk:
+            on_chunk(result)
+        
+        if max_errors and len(errors) >= max_errors:
+            # Chỉ là dừng sớm nếu thật sự còn dòng chưa xử lý
+            result.stopped = next(rows, None) is not None
+            break
+    
+    if result.success_count and not dry_run:
+        invalidate_class_stats()
+    
+    return result
+
+def build_import_report(result, dry_run=False):
+    """
+    Tổng hợp kết quả import vi phạm (ImportResult) để trả về cho giao diện
+    
+    Returns:
+        dict: status (success/partial/error), message, số dòng đã xử lý, lỗi, dòng trùng và báo cáo từng lô
+    """
+    errors = result.errors
+    duplicates = result.duplicates
+    success_count = result.success_count
+    processed_rows = result.processed_rows
+    chunks = result.chunks
+    report = {
+        "processed_rows": processed_rows,
+        "dry_run": dry_run,
+        "duplicate_count": len(duplicates),
+        # Chỉ trả về một phần danh sách dòng trùng (import lại cả file có thể trùng toàn bộ)
+        "duplicates": duplicates[:IMPORT_MAX_ERRORS],
+        "chunks": chunks
+    }
+    
+    if dry_run:
+        message = (f"🔍 Chạy thử: {success_count} vi phạm sẽ được thêm, {len(duplicates)} dòng trùng, "
+                   f"{len(errors)} lỗi. Chưa có dữ liệu nào được lưu.")
+    elif errors:
+        message = f"Đã import {success_count} vi phạm. Có {len(errors)} lỗi."
+    else:
+        message = f"✅ Đã import thành công {success_count} vi phạm!"
+    if duplicates and not dry_run:
+        message += f" Bỏ qua {len(duplicates)} dòng đã tồn tại."
+    
+    if errors:
+        if result.stopped:
+            message += f" Đã dừng sau {processed_rows} dòng do vượt quá {IMPORT_MAX_ERRORS} lỗi."
+        report.update({
+            "status": "partial" if success_count > 0 else "error",
+            "errors": errors,
+            "success": success_count,
+            "stopped_early": result.stopped,
+            "message": message
+        })
+        return report
+    
+    report.update({
+        "status": "success",
+        "count": success_count,
+        "message": message
+    })
+    return report
+
+def run_bulk_import(job_id, params):
+    """
+    Job nền: import vi phạm từ file Excel đã lưu tạm, cập nhật tiến độ sau mỗi lô
+    File tạm luôn được xóa khi job kết thúc
+    
+    Args:
+        params: {"file_path": str, "filename": str, "dry_run": bool}
+    
+    Returns:
+        dict: báo cáo import (xem build_import_report)
+    """
+    file_path = params["file_path"]
+    stats = {}
+    
+    def report_progress(result):
+        fields = {
+            "processed_rows": result.processed_rows,
+            "error_count": len(result.errors),
+            "message": f"Đã xử lý {result.processed_rows} dòng"
+        }
+        if stats.get('total'):
+            fields["progress"] = min(99, result.processed_rows * 100 // stats['total'])
+        update_job(job_id, **fields)
+    
+    try:
+        violations = iter_excel_violations(file_path, stats)
+        dry_run = bool(params.get("dry_run"))
+        result = import_violations_to_db(
+            violations, max_errors=IMPORT_MAX_ERRORS, on_chunk=report_progress, dry_run=dry_run
+        )
+        report_progress(result)
+        return build_import_report(result, dry_run)
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+# === OLLAMA CLIENT ===
+
+class OllamaUnavailableError(RuntimeError):
+    """Circuit breaker đang mở: không gọi Ollama để endpoint dùng ngay phương án không AI"""
+
+class OllamaService:
+    """
+    Client Ollama dùng chung cho cả app
+    
+    - Một ollama.Client (httpx) cấu hình từ OLLAMA_HOST, tái sử dụng connection pool
+    - Timeout kết nối/đọc cho mỗi lần gọi; retry có backoff với lỗi kết nối và lỗi 5xx/429
+      (không retry khi hết thời gian đọc vì model đang chậm, gọi lại chỉ làm chậm thêm)
+    - Circuit breaker: sau OLLAMA_BREAKER_THRESHOLD lần gọi lỗi liên tiếp thì từ chối ngay trong
+      OLLAMA_BREAKER_COOLDOWN giây, hết thời gian thì cho một request thử lại
+    """
+    
+    def __init__(self, host):
+        self.host = host
+        self.client = ollama.Client(
+            host=host,
+            timeout=httpx.Timeout(OLLAMA_READ_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+        )
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._stats = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0}
+    
+    @staticmethod
+    def _is_retryable(e):
+        if isinstance(e, ollama.ResponseError):
+            return e.status_code == 429 or e.status_code >= 500
+        return isinstance(e, (ConnectionError, httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError))
+    
+    @staticmethod
+    def _is_unhealthy(e):
+        """Lỗi do server (tính vào circuit breaker); lỗi 4xx như sai tên model thì không"""
+        if isinstance(e, ollama.ResponseError):
+            return e.status_code == 429 or e.status_code >= 500
+        return isinstance(e, (ConnectionError, httpx.TransportError))
+    
+    def _acquire(self):
+        """Kiểm tra breaker trước khi gọi, raise OllamaUnavailableError nếu đang ngắt"""
+        with self._lock:
+            self._stats["calls"] += 1
+            if self._opened_at is None:
+                return
+            if not self._probing and time.monotonic() - self._opened_at >= OLLAMA_BREAKER_COOLDOWN:
+                self._probing = True  # Half-open: chỉ một request được thử
+                return
+            self._stats["rejected"] += 1
+        raise OllamaUnavailableError("Ollama tạm thời không phản hồi")
+    
+    def _record(self, healthy):
+        with self._lock:
+            self._probing = False
+            if healthy:
+                self._failures = 0
+                self._opened_at = None
+            else:
+                self._failures += 1
+                self._stats["failures"] += 1
+                if self._failures >= OLLAMA_BREAKER_THRESHOLD:
+                    if self._opened_at is None:
+                        print(f"Ollama circuit breaker opened after {self._failures} failures")
+                    self._opened_at = time.monotonic()
+    
+    def _backoff(self, attempt):
+        with self._lock:
+            self._stats["retries"] += 1
+        time.sleep(OLLAMA_RETRY_BACKOFF * 2 ** attempt)
+    
+    def chat(self, **kwargs):
+        """ollama.chat với timeout, retry và circuit breaker"""
+        self._acquire()
+        attempt = 0
+        while True:
+            try:
+                response = self.client.chat(**kwargs)
+            except Exception as e:
+                if attempt < OLLAMA_MAX_RETRIES and self._is_retryable(e):
+                    self._backoff(attempt)
+                    attempt += 1
+                    continue
+                self._record(not self._is_unhealthy(e))
+                raise
+            self._record(True)
+            return response
+    
+    def stream_chat(self, **kwargs):
+        """ollama.chat(stream=True); chỉ retry khi chưa nhận được đoạn nào"""
+        self._acquire()
+        attempt = 0
+        received = False
+        while True:
+            try:
+                for chunk in self.client.chat(stream=True, **kwargs):
+                    received = True
+                    yield chunk
+            except GeneratorExit:
+                # Client ngắt kết nối giữa chừng: lần gọi chưa hoàn tất nên không tính là thành công
+                # hay thất bại, chỉ trả lại lượt thử (half-open) cho request sau
+                with self._lock:
+                    self._probing = False
+                raise
+            except Exception as e:
+                if not received and attempt < OLLAMA_MAX_RETRIES and self._is_retryable(e):
+                    self._backoff(attempt)
+                    attempt += 1
+                    continue
+                self._record(not self._is_unhealthy(e))
+                raise
+            self._record(True)
+            return
+    
+    def status(self):
+        """Trạng thái breaker và số liệu gọi Ollama"""
+        with self._lock:
+            if self._opened_at is None:
+                state = "closed"
+            elif time.monotonic() - self._opened_at >= OLLAMA_BREAKER_COOLDOWN:
+                state = "half_open"
+            else:
+                state = "open"
+            return dict(self._stats, host=self.host, state=state, consecutive_failures=self._failures)
+
+ollama_client = OllamaService(OLLAMA_HOST)
+
+# Ghi chú kèm nội dung thay thế khi AI không khả dụng
+AI_FALLBACK_NOTE = "(AI hiện không khả dụng, đây là số liệu tóm tắt.)"
+
+# === LLM RESPONSE CACHE ===
+
+# Số response giữ trong cache (LRU, lưu cả trong CSDL để còn sau khi khởi động lại)
+LLM_CACHE_SIZE = 500
+# TTL theo từng nơi gọi (giây). Prompt đã chứa số liệu nên dữ liệu đổi thì khóa cũng đổi,
+# TTL chỉ giới hạn việc dùng lại cùng một câu trả lời quá lâu
+LLM_TTL_CLASS_HISTORY = 30 * 24 * 3600  # Tuần đã kết thúc: số liệu không đổi nữa
+LLM_TTL_CLASS_CURRENT = 10 * 60
+LLM_TTL_STUDENT_REPORT = 24 * 3600
+
+_llm_cache = OrderedDict()  # key -> (response, expires_at)
+_llm_cache_state = {"loaded": False}
+_llm_cache_stats = {"hits": 0, "misses": 0, "bypass": 0}
+_llm_cache_lock = threading.Lock()
+
+def llm_cache_key(model, prompt, is_json=False):
+    """Khóa cache LLM: sha256 của (model, is_json, prompt)"""
+    raw = f"{model}\n{int(bool(is_json))}\n{prompt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _load_llm_cache():
+    """Nạp các response còn hạn, dùng gần nhất từ CSDL vào bộ nhớ (một lần mỗi process)"""
+    if _llm_cache_state["loaded"]:
+        return
+    now = datetime.datetime.utcnow()
+    rows = LlmCache.query.filter(LlmCache.expires_at > now)\
+        .order_by(LlmCache.last_used_at.desc()).limit(LLM_CACHE_SIZE).all()
+    with _llm_cache_lock:
+        for row in reversed(rows):
+            _llm_cache[row.key] = (json.loads(row.response), row.expires_at)
+        _llm_cache_state["loaded"] = True
+
+def get_llm_cache(key):
+    """
+    Lấy response LLM đã cache (còn hạn)
+    
+    Returns:
+        str | dict | None: response đã cache, None nếu chưa có hoặc đã hết hạn
+    """
+    _load_llm_cache()
+    now = datetime.datetime.utcnow()
+    with _llm_cache_lock:
+        entry = _llm_cache.get(key)
+        if entry is not None:
+            _llm_cache.move_to_end(key)
+    
+    if entry is None:
+        # Có thể do worker khác vừa ghi vào CSDL
+        row = db.session.get(LlmCache, key)
+        if row:
+            entry = (json.loads(row.response), row.expires_at)
+            with _llm_cache_lock:
+                _llm_cache[key] = entry
+    
+    expired = entry is not None and entry[1] <= now
+    if expired:
+        with _llm_cache_lock:
+            _llm_cache.pop(key, None)
+        LlmCache.query.filter_by(key=key).delete()
+        db.session.commit()
+        entry = None
+    
+    with _llm_cache_lock:
+        _llm_cache_stats["hits" if entry is not None else "misses"] += 1
+    if entry is not None:
+        LlmCache.query.filter_by(key=key).update({"last_used_at": now})
+        db.session.commit()
+        return entry[0]
+    return None
+
+def put_llm_cache(key, response, ttl):
+    """Lưu response LLM với TTL (giây), loại bỏ response ít dùng nhất khi vượt LLM_CACHE_SIZE"""
+    _load_llm_cache()
+    now = datetime.datetime.utcnow()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    with _llm_cache_lock:
+        _llm_cache[key] = (response, expires_at)
+        _llm_cache.move_to_end(key)
+        evicted = []
+        while len(_llm_cache) > LLM_CACHE_SIZE:
+            evicted.append(_llm_cache.popitem(last=False)[0])
     
     try:
+        db.session.merge(LlmCache(
+            key=key,
+            model=OLLAMA_MODEL,
+            response=json.dumps(response, ensure_ascii=False),
+            created_at=now,
+            expires_at=expires_at,
+            last_used_at=now
+        ))
+        # Dọn luôn các dòng đã hết hạn để bảng không phình ra
+        LlmCache.query.filter(or_(LlmCache.key.in_(evicted), LlmCache.expires_at <= now))\
+            .delete(synchronize_session=False)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
-        errors.append(f"Lỗi lưu database: {str(e)}")
-    
-    return errors, success_count
+        print(f"LLM Cache Error: {e}")
 
-def _call_gemini(prompt, image_path=None, is_json=False):
+def _call_gemini(prompt, image_path=None, is_json=False, image_bytes=None, cache_ttl=None, bypass_cache=False):
     """
     Gọi Ollama local model để xử lý text hoặc vision tasks
     
@@ -316,19 +1379,35 @@ def _call_gemini(prompt, image_path=None, is_json=False):
         prompt (str): Text prompt
         image_path (str, optional): Đường dẫn đến file ảnh
         is_json (bool): Yêu cầu response dạng JSON
+        image_bytes (bytes, optional): Nội dung ảnh trong bộ nhớ (không cần ghi ra file)
+        cache_ttl (int, optional): Cache response text-only trong cache_ttl giây (None = không cache)
+        bypass_cache (bool): Bỏ qua cache và gọi lại model ("Tạo lại"), kết quả mới vẫn được lưu
     
     Returns:
         tuple: (response_text/dict, error_message)
     """
+    cache_key = None
+    if cache_ttl and not (image_path or image_bytes):
+        cache_key = llm_cache_key(OLLAMA_MODEL, prompt, is_json)
+        if bypass_cache:
+            with _llm_cache_lock:
+                _llm_cache_stats["bypass"] += 1
+        else:
+            cached = get_llm_cache(cache_key)
+            if cached is not None:
+                return cached, None
+    
     try:
         # Prepare messages
         messages = []
         
-        if image_path:
-            # Vision task - sử dụng ollama.chat với images
+        if image_path or image_bytes:
+            # Vision task - sử dụng ollama_client.chat với images
             try:
-                with open(image_path, "rb") as image_file:
-                    image_data = base64.b64encode(image_file.read()).decode("utf-8")
+                if image_bytes is None:
+                    with open(image_path, "rb") as image_file:
+                        image_bytes = image_file.read()
+                image_data = base64.b64encode(image_bytes).decode("utf-8")
                 
                 messages.append({
                     'role': 'user',
@@ -351,7 +1430,7 @@ def _call_gemini(prompt, image_path=None, is_json=False):
             messages[0]['content'] = f"{prompt}\n\nIMPORTANT: Response MUST be valid JSON only, no additional text."
         
         # Call Ollama
-        response = ollama.chat(
+        response = ollama_client.chat(
             model=OLLAMA_MODEL,
             messages=messages,
             options=options
@@ -374,17 +1453,39 @@ def _call_gemini(prompt, image_path=None, is_json=False):
                         json_end = text.find('```', json_start)
                         text = text[json_start:json_end].strip()
                     
-                    return json.loads(text), None
+                    result = json.loads(text)
                 except json.JSONDecodeError as e:
                     return None, f"Lỗi parse JSON: {str(e)}\nResponse: {text[:200]}"
+            else:
+                result = text
             
-            return text, None
+            if cache_key:
+                put_llm_cache(cache_key, result, cache_ttl)
+            return result, None
         else:
             return None, "Không nhận được response từ Ollama"
             
     except Exception as e:
         return None, f"Lỗi kết nối Ollama: {str(e)}"
 
+def _stream_gemini(prompt):
+    """
+    Gọi Ollama với stream=True cho text task
+    
+    Args:
+        prompt (str): Text prompt
+    
+    Yields:
+        str: Từng đoạn text ngay khi model sinh ra (lỗi kết nối được raise cho nơi gọi xử lý)
+    """
+    stream = ollama_client.stream_chat(
+        model=OLLAMA_MODEL,
+        messages=[{'role': 'user', 'content': prompt}]
+    )
+    for chunk in stream:
+        if chunk and 'message' in chunk and 'content' in chunk['message']:
+            yield chunk['message']['content']
+
 
 @app.route('/')
 def welcome(): return render_template('welcome.html')
@@ -410,26 +1511,93 @@ def logout():
 def index():
     search = request.args.get('search', '').strip()
     selected_class = request.args.get('class_select', '').strip()
-    q = Student.query
-    if selected_class: q = q.filter_by(student_class=selected_class)
-    if search: q = q.filter(or_(Student.name.ilike(f"%{search}%"), Student.student_code.ilike(f"%{search}%")))
-    students = q.order_by(Student.student_code.asc()).all()
+    if search:
+        students = search_students(search, student_class=selected_class or None)
+    else:
+        q = Student.query
+        if selected_class: q = q.filter_by(student_class=selected_class)
+        students = q.order_by(Student.student_code.asc()).all()
+    
+    # Calculate GPA for the whole roster in one grouped query
+    semester, school_year = get_current_term()
+    student_gpas = calculate_gpa_batch([s.id for s in students], semester, school_year)
+    
+    return render_template('index.html', students=students, student_gpas=student_gpas, search_query=search, selected_class=selected_class)
+
+def get_current_term():
+    """
+    Determine current semester and school year from the current week
+    Simple logic: weeks 1-20 = semester 1, weeks 21-40 = semester 2
     
-    # Calculate GPA for each student
+    Returns:
+        tuple: (semester, school_year)
+    """
     week_cfg = SystemConfig.query.filter_by(key="current_week").first()
     current_week = int(week_cfg.value) if week_cfg else 1
-    
-    # Determine current semester and school year
-    # Simple logic: weeks 1-20 = semester 1, weeks 21-40 = semester 2
     semester = 1 if current_week <= 20 else 2
     school_year = "2023-2024"  # Could be made dynamic later
+    return semester, school_year
+
+def compute_subject_average(tx_sum, tx_count, gk_sum, gk_count, hk_sum, hk_count):
+    """
+    Subject average from per-type sums/counts
+    Formula: (TX + GK*2 + HK*3) / 6, only when all three types have scores
+    
+    Returns:
+        float or None
+    """
+    if not (tx_count and gk_count and hk_count):
+        return None
+    avg_tx = tx_sum / tx_count
+    avg_gk = gk_sum / gk_count
+    avg_hk = hk_sum / hk_count
+    return round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
+
+def compute_gpa(subject_averages):
+    """Average of all valid subject averages, rounded to 2 decimals (None if empty)"""
+    valid = [avg for avg in subject_averages if avg is not None]
+    if not valid:
+        return None
+    return round(sum(valid) / len(valid), 2)
+
+# SQLite giới hạn số tham số trong một câu lệnh, chia nhỏ danh sách ID
+GPA_BATCH_SIZE = 500
+
+def calculate_gpa_batch(student_ids, semester, school_year):
+    """
+    Calculate GPA for a whole roster with one SubjectAverage query per batch of IDs
+    (instead of one Grade query per student)
+    
+    Args:
+        student_ids: iterable of Student.id
+        semester (int): Học kỳ
+        school_year (str): Năm học
     
-    student_gpas = {}
-    for student in students:
-        gpa = calculate_student_gpa(student.id, semester, school_year)
-        student_gpas[student.id] = gpa
+    Returns:
+        dict: {student_id: GPA (0.0 - 10.0) or None if no complete subject}
+    """
+    student_ids = list(student_ids)
+    gpas = {sid: None for sid in student_ids}
+    if not student_ids:
+        return gpas
     
-    return render_template('index.html', students=students, student_gpas=student_gpas, search_query=search, selected_class=selected_class)
+    # {student_id: [subject average, ...]}
+    averages = {}
+    for i in range(0, len(student_ids), GPA_BATCH_SIZE):
+        chunk = student_ids[i:i + GPA_BATCH_SIZE]
+        rows = SubjectAverage.query.filter(
+            SubjectAverage.student_id.in_(chunk),
+            SubjectAverage.semester == semester,
+            SubjectAverage.school_year == school_year
+        ).all()
+        
+        for sa in rows:
+            averages.setdefault(sa.student_id, []).append(subject_average_value(sa))
+    
+    for student_id, subject_averages in averages.items():
+        gpas[student_id] = compute_gpa(subject_averages)
+    
+    return gpas
 
 def calculate_student_gpa(student_id, semester, school_year):
     """
@@ -439,44 +1607,281 @@ def calculate_student_gpa(student_id, semester, school_year):
     Returns:
         float: GPA value (0.0 - 10.0) or None if no grades
     """
-    grades = Grade.query.filter_by(
+    return calculate_gpa_batch([student_id], semester, school_year)[student_id]
+
+# === SUBJECT AVERAGE (MATERIALIZED) HELPER FUNCTIONS ===
+
+def subject_average_value(sa):
+    """TBM của một dòng SubjectAverage (None nếu chưa đủ TX/GK/HK)"""
+    return compute_subject_average(sa.tx_sum, sa.tx_count, sa.gk_sum, sa.gk_count, sa.hk_sum, sa.hk_count)
+
+def get_subject_averages(student_id, semester, school_year):
+    """
+    Lấy điểm tổng hợp các môn của học sinh trong một học kỳ
+    
+    Returns:
+        dict: {subject_id: SubjectAverage}
+    """
+    rows = SubjectAverage.query.options(joinedload(SubjectAverage.subject)).filter_by(
         student_id=student_id,
         semester=semester,
         school_year=school_year
     ).all()
+    return {sa.subject_id: sa for sa in rows}
+
+def refresh_subject_average(student_id, subject_id, semester, school_year):
+    """
+    Tính lại dòng SubjectAverage của (học sinh, môn, học kỳ, năm học) từ bảng Grade
+    Gọi trước db.session.commit() để cập nhật cùng transaction với thao tác ghi điểm
+    
+    Returns:
+        SubjectAverage or None (nếu không còn điểm nào)
+    """
+    key = dict(student_id=student_id, subject_id=subject_id, semester=semester, school_year=school_year)
+    rows = db.session.query(
+        Grade.grade_type,
+        func.sum(Grade.score),
+        func.count(Grade.id)
+    ).filter_by(**key).group_by(Grade.grade_type).all()
+    totals = {grade_type: (total, count) for grade_type, total, count in rows}
     
-    if not grades:
+    sa = SubjectAverage.query.filter_by(**key).first()
+    if not totals:
+        if sa:
+            db.session.delete(sa)
         return None
     
-    # Group by subject
-    grades_by_subject = {}
+    if not sa:
+        sa = SubjectAverage(**key)
+        db.session.add(sa)
+    sa.tx_sum, sa.tx_count = totals.get('TX', (0.0, 0))
+    sa.gk_sum, sa.gk_count = totals.get('GK', (0.0, 0))
+    sa.hk_sum, sa.hk_count = totals.get('HK', (0.0, 0))
+    return sa
+
+def rebuild_subject_averages(check_only=False):
+    """
+    Dựng lại toàn bộ bảng SubjectAverage từ Grade và kiểm tra sai lệch (drift)
+    
+    Args:
+        check_only (bool): Chỉ báo cáo sai lệch, không ghi lại bảng
+    
+    Returns:
+        dict: {"rows", "missing", "stale", "drifted"}
+    """
+    rows = db.session.query(
+        Grade.student_id,
+        Grade.subject_id,
+        Grade.semester,
+        Grade.school_year,
+        Grade.grade_type,
+        func.sum(Grade.score),
+        func.count(Grade.id)
+    ).group_by(
+        Grade.student_id, Grade.subject_id, Grade.semester, Grade.school_year, Grade.grade_type
+    ).all()
+    
+    fresh = {}
+    for student_id, subject_id, semester, school_year, grade_type, total, count in rows:
+        key = (student_id, subject_id, semester, school_year)
+        data = fresh.setdefault(key, {'tx_sum': 0.0, 'tx_count': 0, 'gk_sum': 0.0, 'gk_count': 0, 'hk_sum': 0.0, 'hk_count': 0})
+        prefix = grade_type.lower()
+        if prefix in ('tx', 'gk', 'hk'):
+            data[f'{prefix}_sum'] = total
+            data[f'{prefix}_count'] = count
+    
+    existing = {
+        (sa.student_id, sa.subject_id, sa.semester, sa.school_year): sa
+        for sa in SubjectAverage.query.all()
+    }
+    
+    report = {"rows": len(fresh), "missing": 0, "stale": 0, "drifted": 0}
+    for key, data in fresh.items():
+        sa = existing.get(key)
+        if not sa:
+            report["missing"] += 1
+        elif any(abs((getattr(sa, col) or 0) - value) > 1e-9 for col, value in data.items()):
+            report["drifted"] += 1
+    report["stale"] = len(set(existing) - set(fresh))
+    
+    if not check_only:
+        SubjectAverage.query.delete()
+        for (student_id, subject_id, semester, school_year), data in fresh.items():
+            db.session.add(SubjectAverage(
+                student_id=student_id, subject_id=subject_id,
+                semester=semester, school_year=school_year, **data
+            ))
+        db.session.commit()
+    
+    return report
+
+# === TRANSCRIPT HELPER FUNCTIONS ===
+
+@dataclass
+class SubjectTranscript:
+    """Điểm của một môn trong học kỳ (dùng chung cho học bạ, báo cáo phụ huynh, chatbot)"""
+    subject: Subject
+    tx_scores: list = field(default_factory=list)
+    gk_scores: list = field(default_factory=list)
+    hk_scores: list = field(default_factory=list)
+    avg_score: float = None
+
+    @property
+    def avg_tx(self):
+        return sum(self.tx_scores) / len(self.tx_scores) if self.tx_scores else None
+
+    @property
+    def avg_gk(self):
+        return sum(self.gk_scores) / len(self.gk_scores) if self.gk_scores else None
+
+    @property
+    def avg_hk(self):
+        return sum(self.hk_scores) / len(self.hk_scores) if self.hk_scores else None
+
+@dataclass
+class Transcript:
+    """Bảng điểm của học sinh trong một học kỳ"""
+    student_id: int
+    semester: int
+    school_year: str
+    subjects: list = field(default_factory=list)
+    gpa: float = None
+
+    @property
+    def graded_subjects(self):
+        """Các môn đã đủ điểm TX/GK/HK (có TBM)"""
+        return [item for item in self.subjects if item.avg_score is not None]
+
+def build_transcript(student_id, semester, school_year):
+    """
+    Dựng bảng điểm học kỳ với số truy vấn cố định:
+    danh sách môn, toàn bộ điểm của học kỳ (1 truy vấn) và bảng SubjectAverage
+    
+    Returns:
+        Transcript
+    """
+    subjects = Subject.query.order_by(Subject.name).all()
+    averages = get_subject_averages(student_id, semester, school_year)
+    grades = Grade.query.filter_by(
+        student_id=student_id,
+        semester=semester,
+        school_year=school_year
+    ).all()
+    
+    items = {subject.id: SubjectTranscript(subject=subject) for subject in subjects}
+    buckets = {'TX': 'tx_scores', 'GK': 'gk_scores', 'HK': 'hk_scores'}
     for grade in grades:
-        if grade.subject_id not in grades_by_subject:
-            grades_by_subject[grade.subject_id] = {'TX': [], 'GK': [], 'HK': []}
-        grades_by_subject[grade.subject_id][grade.grade_type].append(grade.score)
-    
-    # Calculate average for each subject
-    subject_averages = []
-    for subject_id, data in grades_by_subject.items():
-        if data['TX'] and data['GK'] and data['HK']:
-            avg_tx = sum(data['TX']) / len(data['TX'])
-            avg_gk = sum(data['GK']) / len(data['GK'])
-            avg_hk = sum(data['HK']) / len(data['HK'])
-            subject_avg = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-            subject_averages.append(subject_avg)
-    
-    if not subject_averages:
-        return None
+        item = items.get(grade.subject_id)
+        if item and grade.grade_type in buckets:
+            getattr(item, buckets[grade.grade_type]).append(grade.score)
+    
+    for subject_id, item in items.items():
+        sa = averages.get(subject_id)
+        item.avg_score = subject_average_value(sa) if sa else None
+    
+    transcript = Transcript(
+        student_id=student_id,
+        semester=semester,
+        school_year=school_year,
+        subjects=list(items.values())
+    )
+    transcript.gpa = compute_gpa(item.avg_score for item in transcript.subjects)
+    return transcript
+
+# === DASHBOARD STATS CACHE ===
+
+# Kết quả thống kê theo (lớp, tuần) được cache trong bộ nhớ.
+# invalidate_class_stats(): thêm/xóa/import vi phạm, sửa học sinh/lớp, lưu trữ và chuyển tuần
+CLASS_STATS_CACHE_TTL = 300
+_class_stats_cache = {}
+_class_stats_generation = 0
+_class_stats_lock = threading.Lock()
+
+def _compute_class_week_stats(s_class, week, from_archive):
+    """Phân loại Tốt/Khá/Cần cố gắng bằng một truy vấn conditional aggregation + top 5 lỗi"""
+    if from_archive:
+        score = WeeklyArchive.final_score
+        q = db.session.query(
+            func.sum(case((score >= 90, 1), else_=0)),
+            func.sum(case(((score >= 70) & (score < 90), 1), else_=0)),
+            func.sum(case((score < 70, 1), else_=0))
+        ).filter(WeeklyArchive.week_number == week)
+        if s_class: q = q.filter(WeeklyArchive.student_class == s_class)
+    else:
+        score = Student.current_score
+        q = db.session.query(
+            func.sum(case((score >= 90, 1), else_=0)),
+            func.sum(case(((score >= 70) & (score < 90), 1), else_=0)),
+            func.sum(case((score < 70, 1), else_=0))
+        )
+        if s_class: q = q.filter(Student.student_class == s_class)
+    c_tot, c_kha, c_tb = q.one()
+    
+    vios_q = db.session.query(Violation.violation_type_name, func.count(Violation.violation_type_name).label("c"))
+    vios_q = vios_q.filter(Violation.week_number == week)
+    if s_class:
+        vios_q = vios_q.join(Student).filter(Student.student_class == s_class)
+    top = vios_q.group_by(Violation.violation_type_name).order_by(desc("c")).limit(5).all()
+    
+    return {
+        "pie": [c_tot or 0, c_kha or 0, c_tb or 0],
+        "top": [(name, count) for name, count in top]
+    }
+
+def get_class_week_stats(s_class, week, from_archive=False):
+    """
+    Thống kê rèn luyện của một lớp (hoặc toàn trường nếu s_class rỗng) trong một tuần
+    
+    Args:
+        s_class (str): Tên lớp, rỗng = toàn trường
+        week (int): Số tuần
+        from_archive (bool): Lấy điểm từ WeeklyArchive (tuần cũ) thay vì Student
+    
+    Returns:
+        dict: {"pie": [tốt, khá, cần cố gắng], "top": [(tên lỗi, số lần), ...]}
+    """
+    key = (s_class or "", week, from_archive)
+    now = time.time()
+    with _class_stats_lock:
+        cached = _class_stats_cache.get(key)
+        if cached and now - cached[0] < CLASS_STATS_CACHE_TTL:
+            return cached[1]
+        generation = _class_stats_generation
+    
+    stats = _compute_class_week_stats(s_class, week, from_archive)
+    
+    with _class_stats_lock:
+        # Bỏ qua nếu có thao tác ghi xen giữa lúc đang tính
+        if generation == _class_stats_generation:
+            _class_stats_cache[key] = (now, stats)
+    return stats
+
+def invalidate_class_stats(classes=None, week=None):
+    """
+    Xóa cache thống kê bị ảnh hưởng bởi một thao tác ghi
     
-    # Calculate overall GPA
-    gpa = round(sum(subject_averages) / len(subject_averages), 2)
-    return gpa
+    Args:
+        classes (iterable, optional): Các lớp bị ảnh hưởng (None = tất cả). Thống kê toàn trường luôn bị xóa.
+        week (int, optional): Tuần bị ảnh hưởng (None = mọi tuần)
+    """
+    global _class_stats_generation
+    classes = set(classes) if classes is not None else None
+    with _class_stats_lock:
+        _class_stats_generation += 1
+        for key in list(_class_stats_cache):
+            key_class, key_week, _ = key
+            if week is not None and key_week != week:
+                continue
+            if classes is not None and key_class and key_class not in classes:
+                continue
+            del _class_stats_cache[key]
 
 
 @app.route("/dashboard")
 @login_required
 def dashboard():
     show_reset_warning = is_reset_needed()
+    rollover_job = get_active_job("week_rollover")
     
     # 1. Lấy số thứ tự tuần hiện tại
     w_cfg = SystemConfig.query.filter_by(key="current_week").first()
@@ -484,106 +1889,88 @@ def dashboard():
     
     s_class = request.args.get("class_select")
     
-    # 2. Thống kê điểm số (Của hiện tại)
-    q = Student.query.filter_by(student_class=s_class) if s_class else Student.query
-    c_tot = q.filter(Student.current_score >= 90).count()
-    c_kha = q.filter(Student.current_score >= 70, Student.current_score < 90).count()
-    c_tb = q.filter(Student.current_score < 70).count()
-    
-    # 3. Thống kê lỗi (CHỈ LẤY CỦA TUẦN HIỆN TẠI) -> Đây là mấu chốt để "reset" visual
-    vios_q = db.session.query(Violation.violation_type_name, func.count(Violation.violation_type_name).label("c"))
-    
-    # Lọc theo tuần hiện tại
-    vios_q = vios_q.filter(Violation.week_number == current_week)
-    
-    if s_class: 
-        vios_q = vios_q.join(Student).filter(Student.student_class == s_class)
-        
-    top = vios_q.group_by(Violation.violation_type_name).order_by(desc("c")).limit(5).all()
+    # 2. Thống kê điểm số (Của hiện tại) + 3. Thống kê lỗi (CHỈ LẤY CỦA TUẦN HIỆN TẠI)
+    # -> Đây là mấu chốt để "reset" visual. Kết quả được cache theo (lớp, tuần)
+    stats = get_class_week_stats(s_class, current_week)
+    top = stats["top"]
     
     return render_template("dashboard.html", 
                            show_reset_warning=show_reset_warning,
+                           rollover_job=job_to_dict(rollover_job) if rollover_job else None,
                            selected_class=s_class, 
                            pie_labels=json.dumps(["Tốt", "Khá", "Cần cố gắng"]), 
-                           pie_data=json.dumps([c_tot, c_kha, c_tb]), 
+                           pie_data=json.dumps(stats["pie"]), 
                            bar_labels=json.dumps([n for n, _ in top]), 
                            bar_data=json.dumps([c for _, c in top]))
 
 # --- Thêm vào app.py ---
 
+def run_class_analysis(job_id, params):
+    """Job AI: phân tích nề nếp của một lớp (hoặc toàn trường) trong một tuần"""
+    s_class = params.get("class_name", "")
+    week_req = params.get("week")
+    
+    # Xác định tuần cần phân tích
+    sys_week_cfg = SystemConfig.query.filter_by(key="current_week").first()
+    sys_week = int(sys_week_cfg.value) if sys_week_cfg else 1
+    target_week = int(week_req) if week_req else sys_week
+    
+    # Kiểm tra xem có phải là xem lại lịch sử không
+    is_history = (target_week < sys_week)
+    
+    # 1. Lấy thống kê Phân loại (Tốt/Khá/TB) và Top vi phạm (Lọc đúng theo tuần target_week)
+    # Nếu là lịch sử: Lấy từ bảng lưu trữ WeeklyArchive, nếu là hiện tại: Lấy từ bảng Student
+    stats = get_class_week_stats(s_class, target_week, from_archive=is_history)
+    c_tot, c_kha, c_tb = stats["pie"]
+    total_students = c_tot + c_kha + c_tb
+    
+    top_violations = stats["top"]
+    violations_text = ", ".join([f"{name} ({count} lần)" for name, count in top_violations])
+    if not violations_text: violations_text = "Không có vi phạm đáng kể."
+
+    # 3. Tạo Prompt gửi AI
+    context_name = f"Lớp {s_class}" if s_class else "Toàn Trường"
+    time_context = f"TUẦN {target_week}"
+    
+    prompt = f"""
+    Đóng vai Trợ lý Giáo dục. Phân tích nề nếp {time_context} của {context_name}:
+    - Tổng sĩ số: {total_students}
+    - Kết quả rèn luyện: Tốt {c_tot}, Khá {c_kha}, Trung bình/Yếu {c_tb}.
+    - Các lỗi vi phạm chính trong tuần: {violations_text}
+
+    Yêu cầu trả lời:
+    - Viết một đoạn nhận xét ngắn gọn (khoảng 3-4 câu).
+    - Giọng văn khách quan, sư phạm nhưng thẳng thắn.
+    - Chỉ ra điểm tích cực (nếu tỉ lệ Tốt cao) hoặc vấn đề báo động (nếu vi phạm nhiều).
+    - Đưa ra 1 lời khuyên cụ thể cho giáo viên chủ nhiệm để chấn chỉnh lớp trong tuần tới.
+    - Không dùng các định dạng markdown như * đậm * hay dấu hoa thị đầu dòng, viết thành đoạn văn xuôi.
+    """
+    
+    # Tuần đã kết thúc thì số liệu cố định: cache lâu, xem lại gần như tức thì
+    ttl = LLM_TTL_CLASS_HISTORY if is_history else LLM_TTL_CLASS_CURRENT
+    analysis_text, error = _call_gemini(prompt, cache_ttl=ttl, bypass_cache=params.get("regenerate", False))
+    if error:
+        # AI lỗi/không khả dụng: trả về số liệu tóm tắt thay cho nhận xét
+        print(f"Class Analysis AI Error: {error}")
+        analysis_text = (
+            f"{context_name} - {time_context}: sĩ số {total_students}, "
+            f"Tốt {c_tot}, Khá {c_kha}, Trung bình/Yếu {c_tb}. "
+            f"Các lỗi vi phạm chính: {violations_text.rstrip('.')}. {AI_FALLBACK_NOTE}"
+        )
+        return {"analysis": analysis_text, "fallback": True}
+    return {"analysis": analysis_text}
+
 @app.route("/api/analyze_class_stats", methods=["POST"])
 @login_required
 def analyze_class_stats():
-    try:
-        data = request.get_json()
-        s_class = data.get("class_name", "")
-        # Nhận tham số tuần từ request (nếu có)
-        week_req = data.get("week", None)
-        
-        # Xác định tuần cần phân tích
-        sys_week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        sys_week = int(sys_week_cfg.value) if sys_week_cfg else 1
-        target_week = int(week_req) if week_req else sys_week
-        
-        # Kiểm tra xem có phải là xem lại lịch sử không
-        is_history = (target_week < sys_week)
-        
-        # 1. Lấy thống kê Phân loại (Tốt/Khá/TB)
-        if is_history:
-            # Nếu là lịch sử: Lấy từ bảng lưu trữ WeeklyArchive
-            q = WeeklyArchive.query.filter_by(week_number=target_week)
-            if s_class: q = q.filter_by(student_class=s_class)
-            
-            c_tot = q.filter(WeeklyArchive.final_score >= 90).count()
-            c_kha = q.filter(WeeklyArchive.final_score >= 70, WeeklyArchive.final_score < 90).count()
-            c_tb = q.filter(WeeklyArchive.final_score < 70).count()
-        else:
-            # Nếu là hiện tại: Lấy từ bảng Student
-            q = Student.query
-            if s_class: q = q.filter_by(student_class=s_class)
-            
-            c_tot = q.filter(Student.current_score >= 90).count()
-            c_kha = q.filter(Student.current_score >= 70, Student.current_score < 90).count()
-            c_tb = q.filter(Student.current_score < 70).count()
-            
-        total_students = c_tot + c_kha + c_tb
-        
-        # 2. Lấy Top vi phạm (Lọc đúng theo tuần target_week)
-        vios_q = db.session.query(Violation.violation_type_name, func.count(Violation.violation_type_name).label("c"))
-        vios_q = vios_q.filter(Violation.week_number == target_week)
-        
-        if s_class:
-            vios_q = vios_q.join(Student).filter(Student.student_class == s_class)
-        
-        top_violations = vios_q.group_by(Violation.violation_type_name).order_by(desc("c")).limit(5).all()
-        violations_text = ", ".join([f"{name} ({count} lần)" for name, count in top_violations])
-        if not violations_text: violations_text = "Không có vi phạm đáng kể."
-
-        # 3. Tạo Prompt gửi AI
-        context_name = f"Lớp {s_class}" if s_class else "Toàn Trường"
-        time_context = f"TUẦN {target_week}"
-        
-        prompt = f"""
-        Đóng vai Trợ lý Giáo dục. Phân tích nề nếp {time_context} của {context_name}:
-        - Tổng sĩ số: {total_students}
-        - Kết quả rèn luyện: Tốt {c_tot}, Khá {c_kha}, Trung bình/Yếu {c_tb}.
-        - Các lỗi vi phạm chính trong tuần: {violations_text}
-
-        Yêu cầu trả lời:
-        - Viết một đoạn nhận xét ngắn gọn (khoảng 3-4 câu).
-        - Giọng văn khách quan, sư phạm nhưng thẳng thắn.
-        - Chỉ ra điểm tích cực (nếu tỉ lệ Tốt cao) hoặc vấn đề báo động (nếu vi phạm nhiều).
-        - Đưa ra 1 lời khuyên cụ thể cho giáo viên chủ nhiệm để chấn chỉnh lớp trong tuần tới.
-        - Không dùng các định dạng markdown như * đậm * hay dấu hoa thị đầu dòng, viết thành đoạn văn xuôi.
-        """
-        
-        analysis_text, error = _call_gemini(prompt)
-        if error: return jsonify({"error": error}), 500
-            
-        return jsonify({"analysis": analysis_text})
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    """Phân tích nề nếp bằng AI (gửi "async": true để nhận job_id thay vì chờ kết quả)"""
+    data = request.get_json(silent=True) or {}
+    params = {
+        "class_name": data.get("class_name", ""),
+        "week": data.get("week"),
+        "regenerate": bool(data.get("regenerate"))
+    }
+    return respond_ai_job("class_analysis", run_class_analysis, params, wait=not data.get("async"))
 #Thêm vi phạm(remake)
 # --- Thay thế hàm add_violation cũ bằng hàm này ---
 
@@ -608,42 +1995,59 @@ def add_violation():
         current_week = int(w_cfg.value) if w_cfg else 1
         count = 0
 
-        # Process each violation type
-        for rule_id in selected_rule_ids:
+        # Lấy tất cả lỗi vi phạm được chọn bằng một truy vấn
+        rule_ids = [int(r) for r in selected_rule_ids if str(r).isdigit()]
+        rules = ViolationType.query.filter(ViolationType.id.in_(rule_ids)).all() if rule_ids else []
+        rules_by_id = {r.id: r for r in rules}
+        rules = [rules_by_id[r] for r in rule_ids if r in rules_by_id]
+
+        # Lấy tất cả học sinh được chọn bằng một truy vấn IN (mỗi học sinh chỉ tính một lần)
+        student_ids = []
+        # A. Xử lý danh sách từ Dropdown chọn tay
+        if selected_student_ids:
+            ids = list(dict.fromkeys(int(s) for s in selected_student_ids if str(s).isdigit()))
+            if ids:
+                found = set(db.session.scalars(select(Student.id).where(Student.id.in_(ids))))
+                student_ids = [s for s in ids if s in found]
+        # B. Xử lý danh sách từ OCR
+        elif ocr_json:
             try:
-                rule = db.session.get(ViolationType, int(rule_id))
-            except:
-                continue
-            
-            if not rule:
-                continue
+                codes = list(dict.fromkeys(str(c).strip() for c in json.loads(ocr_json) if c))
+                code_map = resolve_student_codes(codes)
+                student_ids = list(dict.fromkeys(code_map[c] for c in codes if c in code_map))
+            except Exception as e:
+                print(f"OCR Error: {e}")
 
-            # A. Xử lý danh sách từ Dropdown chọn tay
-            if selected_student_ids:
-                for s_id in selected_student_ids:
-                    student = db.session.get(Student, int(s_id))
-                    if student:
-                        student.current_score = (student.current_score or 100) - rule.points_deducted
-                        db.session.add(Violation(student_id=student.id, violation_type_name=rule.name, points_deducted=rule.points_deducted, week_number=current_week))
-                        count += 1
-            
-            # B. Xử lý danh sách từ OCR (Giữ nguyên logic cũ)
-            elif ocr_json:
-                try:
-                    student_codes = json.loads(ocr_json)
-                    for code in student_codes:
-                        if not code: continue
-                        s = Student.query.filter_by(student_code=str(code).strip()).first()
-                        if s:
-                            s.current_score = (s.current_score or 100) - rule.points_deducted
-                            db.session.add(Violation(student_id=s.id, violation_type_name=rule.name, points_deducted=rule.points_deducted, week_number=current_week))
-                            count += 1
-                except Exception as e:
-                    print(f"OCR Error: {e}")
+        if rules and student_ids:
+            try:
+                # Trừ điểm bằng một câu UPDATE nguyên tử (không đọc-sửa-ghi trong Python)
+                # để nhiều giáo viên ghi vi phạm cùng lúc không ghi đè điểm của nhau
+                total_points = sum(r.points_deducted for r in rules)
+                db.session.execute(
+                    update(Student)
+                    .where(Student.id.in_(student_ids))
+                    .values(current_score=func.coalesce(Student.current_score, 100) - total_points)
+                )
+                # Ghi toàn bộ vi phạm bằng một executemany
+                db.session.execute(insert(Violation), [
+                    {
+                        'student_id': s_id,
+                        'violation_type_name': rule.name,
+                        'points_deducted': rule.points_deducted,
+                        'week_number': current_week
+                    }
+                    for rule in rules for s_id in student_ids
+                ])
+                count = len(rules) * len(student_ids)
+            except Exception as e:
+                db.session.rollback()
+                print(f"Add Violation Error: {e}")
 
         if count > 0:
+            register_violation_weeks([current_week])
             db.session.commit()
-            flash(f"Đã ghi nhận {count} vi phạm (cho {len(selected_student_ids) if selected_student_ids else 'nhiều'} học sinh x {len(selected_rule_ids)} lỗi).", "success")
+            invalidate_class_stats(week=current_week)
+            flash(f"Đã ghi nhận {count} vi phạm (cho {len(student_ids)} học sinh x {len(rules)} lỗi).", "success")
         else:
             flash("Chưa chọn học sinh nào hoặc xảy ra lỗi.", "error")
         
@@ -661,28 +2065,52 @@ def bulk_import_violations():
     """Display bulk import page"""
     students = Student.query.order_by(Student.student_class, Student.name).all()
     violation_types = ViolationType.query.all()
+    import_job = get_active_job("bulk_import", current_user.id)
     return render_template("bulk_import_violations.html", 
                           students=students, 
-                          violation_types=violation_types)
+                          violation_types=violation_types,
+                          import_job=job_to_dict(import_job) if import_job else None)
 
 @app.route("/process_bulk_violations", methods=["POST"])
 @login_required
 def process_bulk_violations():
     """
     Process bulk violation import from either:
-    - Manual form entry (JSON array from frontend)
-    - Excel file upload
+    - Manual form entry (JSON array from frontend) - xử lý ngay
+    - Excel file upload - lưu file tạm và chạy job nền, trả về job_id để theo dõi qua /api/jobs/<job_id>
+    
+    dry_run=1: chỉ kiểm tra và trả về số dòng sẽ thêm/trùng/lỗi, không lưu
     """
     try:
         # Check source type
         excel_file = request.files.get('excel_file')
         manual_data = request.form.get('manual_violations_json')
-        
-        violations_to_import = []
+        dry_run = request.form.get('dry_run') in ('1', 'true', 'on')
         
         if excel_file and excel_file.filename:
-            # Process Excel file
-            violations_to_import = parse_excel_file(excel_file)
+            # Mỗi giáo viên chỉ chạy một lần import tại một thời điểm (bấm lại / tải lại trang sẽ theo dõi job cũ)
+            active_job = get_active_job("bulk_import", current_user.id)
+            if active_job:
+                return jsonify({
+                    "status": "running",
+                    "job_id": active_job.id,
+                    "message": "Đang có một lần import chưa hoàn tất"
+                })
+            
+            ext = os.path.splitext(excel_file.filename)[1].lower()
+            file_path = os.path.join(UPLOAD_FOLDER, f"import_{uuid.uuid4().hex}{ext}")
+            excel_file.save(file_path)
+            
+            job = submit_job("bulk_import", run_bulk_import, {
+                "file_path": file_path,
+                "filename": excel_file.filename,
+                "dry_run": dry_run
+            }, created_by=current_user.id)
+            return jsonify({
+                "status": "queued",
+                "job_id": job.id,
+                "message": "Đã nhận file, đang xử lý..."
+            }), 202
         elif manual_data:
             # Process manual JSON data
             violations_to_import = json.loads(manual_data)
@@ -697,21 +2125,10 @@ def process_bulk_violations():
             return jsonify({"status": "error", "message": "Không có dữ liệu để import"}), 400
         
         # Validate & Import
-        errors, success_count = import_violations_to_db(violations_to_import)
-        
-        if errors:
-            return jsonify({
-                "status": "partial" if success_count > 0 else "error",
-                "errors": errors,
-                "success": success_count,
-                "message": f"Đã import {success_count} vi phạm. Có {len(errors)} lỗi."
-            })
-        
-        return jsonify({
-            "status": "success",
-            "count": success_count,
-            "message": f"✅ Đã import thành công {success_count} vi phạm!"
-        })
+        result = import_violations_to_db(
+            violations_to_import, max_errors=IMPORT_MAX_ERRORS, dry_run=dry_run
+        )
+        return jsonify(build_import_report(result, dry_run))
         
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
@@ -736,13 +2153,553 @@ def download_violation_template():
     
     output.seek(0)
     
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name='template_import_violations.xlsx'
+    return send_file(
+        output,
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        as_attachment=True,
+        download_name='template_import_violations.xlsx'
+    )
+
+
+# === STUDENT MATCHING INDEX ===
+
+# invalidate_student_index(): thêm/sửa/xóa/import học sinh, đổi tên lớp
+STUDENT_INDEX_TTL = 300
+# Số ứng viên tối đa lấy từ n-gram tên cho mỗi lần tìm
+NAME_CANDIDATE_LIMIT = 50
+_student_index_cache = {"data": None, "loaded_at": 0}
+_student_index_lock = threading.Lock()
+
+def normalize_text(text):
+    """Chuẩn hóa text: loại bỏ dấu cách thừa, chuyển thành chữ thường"""
+    if not text:
+        return ""
+    # Loại bỏ dấu cách thừa
+    text = " ".join(text.split())
+    # Chuyển thành chữ thường
+    return text.lower().strip()
+
+def remove_accents(text):
+    """Loại bỏ dấu tiếng Việt"""
+    if not text:
+        return ""
+    # Chuẩn hóa Unicode về dạng NFD (tách dấu)
+    nfd = unicodedata.normalize('NFD', text)
+    # Loại bỏ các ký tự dấu
+    return ''.join(char for char in nfd if unicodedata.category(char) != 'Mn')
+
+def name_ngrams(text, n=3):
+    """Tập n-gram ký tự của tên (đã chuẩn hóa, không dấu)"""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+def substrings(text):
+    """Tập mọi chuỗi con khác rỗng (dùng cho mã số học sinh vốn rất ngắn)"""
+    return {text[i:j] for i in range(len(text)) for j in range(i + 1, len(text) + 1)}
+
+@dataclass
+class StudentMatchEntry:
+    """Thông tin học sinh đã chuẩn hóa sẵn cho fuzzy matching"""
+    order: int
+    id: int
+    name: str
+    student_code: str
+    student_class: str
+    code_upper: str
+    name_norm: str
+    name_no_accent: str
+    class_no_space: str
+    name_grams: set
+
+class StudentMatchIndex:
+    """
+    Index trong bộ nhớ để khớp kết quả OCR với học sinh:
+    - map mã số (chữ hoa) -> học sinh, chuỗi con của mã số -> học sinh (khớp một phần)
+    - lớp viết liền -> danh sách học sinh
+    - n-gram tên không dấu -> học sinh (sinh danh sách ứng viên ngắn thay vì quét toàn bộ)
+    """
+    
+    def __init__(self, students):
+        self.entries = []
+        self.by_code = {}
+        self.by_code_part = {}
+        self.by_class = {}
+        self.by_gram = {}
+        for order, (s_id, name, code, s_class) in enumerate(students):
+            name_norm = normalize_text(name)
+            name_no_accent = remove_accents(name_norm)
+            entry = StudentMatchEntry(
+                order=order, id=s_id, name=name, student_code=code, student_class=s_class,
+                code_upper=(code or "").upper(),
+                name_norm=name_norm,
+                name_no_accent=name_no_accent,
+                class_no_space=normalize_text(s_class).replace(" ", ""),
+                name_grams=name_ngrams(name_no_accent)
+            )
+            self.entries.append(entry)
+            if entry.code_upper:
+                self.by_code.setdefault(entry.code_upper, entry)
+                for part in substrings(entry.code_upper):
+                    self.by_code_part.setdefault(part, []).append(entry)
+            if entry.class_no_space:
+                self.by_class.setdefault(entry.class_no_space, []).append(entry)
+            for gram in entry.name_grams:
+                self.by_gram.setdefault(gram, []).append(entry)
+    
+    def candidates(self, ocr_name_no_accent, ocr_class_no_space, ocr_code):
+        """Danh sách ứng viên có thể đạt điểm > 0 (mã số, lớp, tên gần giống)"""
+        found = {}
+        
+        # Mã số: mã chứa mã OCR (qua map chuỗi con) hoặc nằm trong mã OCR (tra từng chuỗi con của mã OCR)
+        if ocr_code:
+            for entry in self.by_code_part.get(ocr_code, ()):
+                found[entry.order] = entry
+            for part in substrings(ocr_code):
+                entry = self.by_code.get(part)
+                if entry:
+                    found[entry.order] = entry
+        
+        # Tên: học sinh có độ tương đồng n-gram (hệ số Dice) cao nhất
+        if ocr_name_no_accent:
+            grams = name_ngrams(ocr_name_no_accent)
+            if not grams:
+                # Tên quá ngắn để tách n-gram: so sánh trực tiếp
+                for entry in self.entries:
+                    if entry.name_no_accent and (ocr_name_no_accent in entry.name_no_accent or entry.name_no_accent in ocr_name_no_accent):
+                        found[entry.order] = entry
+            else:
+                shared = {}
+                for gram in grams:
+                    for entry in self.by_gram.get(gram, ()):
+                        shared[entry.order] = shared.get(entry.order, 0) + 1
+                # Đồng hạng xếp theo thứ tự học sinh để kết quả ổn định giữa các tiến trình
+                ranked = sorted(
+                    shared.items(),
+                    key=lambda item: (-2 * item[1] / (len(grams) + len(self.entries[item[0]].name_grams)), item[0])
+                )
+                for order, _ in ranked[:NAME_CANDIDATE_LIMIT]:
+                    found[order] = self.entries[order]
+        
+        # Lớp: học sinh của lớp khớp chính xác; lớp khớp một phần chỉ dùng khi còn thiếu ứng viên
+        if ocr_class_no_space:
+            partial = []
+            for class_key, members in self.by_class.items():
+                if class_key == ocr_class_no_space:
+                    for entry in members:
+                        found[entry.order] = entry
+                elif ocr_class_no_space in class_key or class_key in ocr_class_no_space:
+                    partial.extend(members)
+            if len(found) < 3:
+                for entry in partial:
+                    found[entry.order] = entry
+        
+        return [found[order] for order in sorted(found)]
+
+def get_student_match_index():
+    """Lấy StudentMatchIndex (dựng lại khi đã bị invalidate hoặc quá TTL)"""
+    now = time.time()
+    with _student_index_lock:
+        index = _student_index_cache["data"]
+        if index is not None and now - _student_index_cache["loaded_at"] < STUDENT_INDEX_TTL:
+            return index
+    
+    rows = db.session.query(Student.id, Student.name, Student.student_code, Student.student_class).order_by(Student.id).all()
+    index = StudentMatchIndex(rows)
+    with _student_index_lock:
+        _student_index_cache["data"] = index
+        _student_index_cache["loaded_at"] = now
+    return index
+
+def invalidate_student_index():
+    """Xóa index học sinh (gọi sau khi thêm/sửa/xóa học sinh)"""
+    with _student_index_lock:
+        _student_index_cache["data"] = None
+
+def fuzzy_match_students(ocr_name, ocr_class, ocr_code):
+    """
+    Tìm học sinh phù hợp nhất với thông tin OCR
+    Chỉ chấm điểm danh sách ứng viên ngắn lấy từ StudentMatchIndex
+    
+    Returns:
+        list[dict]: top 3 {"student": StudentMatchEntry, "score": int, "reasons": list[str]}
+    """
+    candidates = []
+    
+    # Chuẩn hóa input
+    ocr_name_norm = normalize_text(ocr_name)
+    ocr_name_no_accent = remove_accents(ocr_name_norm)
+    ocr_class_no_space = normalize_text(ocr_class).replace(" ", "")
+    ocr_code = (ocr_code or "").upper()
+    
+    index = get_student_match_index()
+    for student in index.candidates(ocr_name_no_accent, ocr_class_no_space, ocr_code):
+        score = 0
+        reasons = []
+        
+        # So sánh mã số nếu có
+        if ocr_code and student.code_upper:
+            if ocr_code == student.code_upper:
+                score += 100  # Match chính xác mã số = điểm cao nhất
+                reasons.append("Mã số khớp chính xác")
+            elif ocr_code in student.code_upper or student.code_upper in ocr_code:
+                score += 50
+                reasons.append("Mã số khớp một phần")
+        
+        # So sánh lớp (đã loại bỏ khoảng cách: 12Tin == 12 Tin)
+        if ocr_class_no_space and student.class_no_space:
+            if ocr_class_no_space == student.class_no_space:
+                score += 40
+                reasons.append("Lớp khớp chính xác")
+            elif ocr_class_no_space in student.class_no_space or student.class_no_space in ocr_class_no_space:
+                score += 20
+                reasons.append("Lớp khớp một phần")
+        
+        # So sánh tên
+        if ocr_name_norm and student.name_norm:
+            # So sánh có dấu
+            if ocr_name_norm == student.name_norm:
+                score += 60
+                reasons.append("Tên khớp chính xác (có dấu)")
+            # So sánh không dấu
+            elif ocr_name_no_accent == student.name_no_accent:
+                score += 50
+                reasons.append("Tên khớp chính xác (không dấu)")
+            # So sánh chứa
+            elif ocr_name_norm in student.name_norm or student.name_norm in ocr_name_norm:
+                score += 30
+                reasons.append("Tên khớp một phần (có dấu)")
+            elif ocr_name_no_accent in student.name_no_accent or student.name_no_accent in ocr_name_no_accent:
+                score += 25
+                reasons.append("Tên khớp một phần (không dấu)")
+            # Sử dụng difflib để tính similarity
+            else:
+                ratio = SequenceMatcher(None, ocr_name_no_accent, student.name_no_accent).ratio()
+                if ratio > 0.7:  # 70% giống nhau
+                    score += int(ratio * 30)
+                    reasons.append(f"Tên tương tự {int(ratio*100)}%")
+        
+        if score > 0:
+            candidates.append({
+                "student": student,
+                "score": score,
+                "reasons": reasons
+            })
+    
+    # Sắp xếp theo điểm giảm dần
+    candidates.sort(key=lambda x: x["score"], reverse=True)
+    
+    # Trả về top 3
+    return candidates[:3]
+
+# === STUDENT SEARCH INDEX (FTS5) ===
+
+# Bảng FTS5 (tokenizer trigram) chứa tên / mã / lớp đã bỏ dấu, rowid = student.id
+# Được đồng bộ qua ORM event của Student; nếu SQLite không hỗ trợ FTS5 thì tìm bằng ILIKE như cũ
+_student_search_state = {"checked": False, "available": False}
+_student_search_lock = threading.Lock()
+
+def fold_search_text(text):
+    """Chuẩn hóa chuỗi để tìm kiếm: chữ thường, bỏ dấu tiếng Việt (kể cả đ -> d)"""
+    return remove_accents(normalize_text(text)).replace("đ", "d")
+
+def _student_search_row(s_id, name, code, s_class):
+    return {"id": s_id, "name": fold_search_text(name), "code": fold_search_text(code), "class": fold_search_text(s_class)}
+
+def ensure_student_search_index(connection=None):
+    """
+    Tạo bảng student_search nếu chưa có và dựng lại nội dung nếu lệch với bảng student
+    (chỉ kiểm tra một lần mỗi process)
+    
+    Returns:
+        bool: FTS5 có dùng được hay không
+    """
+    if _student_search_state["checked"]:
+        return _student_search_state["available"]
+    with _student_search_lock:
+        if _student_search_state["checked"]:
+            return _student_search_state["available"]
+        conn = connection if connection is not None else db.session.connection()
+        try:
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS student_search "
+                "USING fts5(name, code, class, tokenize='trigram')"
+            ))
+            indexed = conn.execute(text("SELECT count(*) FROM student_search")).scalar()
+            total = conn.execute(select(func.count(Student.id))).scalar()
+            if indexed != total:
+                conn.execute(text("DELETE FROM student_search"))
+                rows = [
+                    _student_search_row(*r)
+                    for r in conn.execute(select(Student.id, Student.name, Student.student_code, Student.student_class))
+                ]
+                if rows:
+                    conn.execute(text(
+                        "INSERT INTO student_search(rowid, name, code, class) VALUES (:id, :name, :code, :class)"
+                    ), rows)
+            if connection is None:
+                db.session.commit()
+            _student_search_state["available"] = True
+        except OperationalError as e:
+            print(f"Student search index unavailable: {e}")
+            if connection is None:
+                db.session.rollback()
+            _student_search_state["available"] = False
+        _student_search_state["checked"] = True
+        return _student_search_state["available"]
+
+@event.listens_for(Student, "after_insert")
+@event.listens_for(Student, "after_update")
+def _sync_student_search(mapper, connection, target):
+    if not ensure_student_search_index(connection):
+        return
+    connection.execute(text("DELETE FROM student_search WHERE rowid = :id"), {"id": target.id})
+    connection.execute(
+        text("INSERT INTO student_search(rowid, name, code, class) VALUES (:id, :name, :code, :class)"),
+        _student_search_row(target.id, target.name, target.student_code, target.student_class)
+    )
+
+@event.listens_for(Student, "after_delete")
+def _delete_student_search(mapper, connection, target):
+    if ensure_student_search_index(connection):
+        connection.execute(text("DELETE FROM student_search WHERE rowid = :id"), {"id": target.id})
+
+def search_students(query, student_class=None, limit=None):
+    """
+    Tìm học sinh theo tên / mã / lớp, không phân biệt dấu ("nguyen van an" khớp "Nguyễn Văn An")
+    Mọi từ trong query đều phải xuất hiện (từ ngắn hơn 3 ký tự khớp theo đầu từ);
+    kết quả xếp theo độ liên quan: trùng tên chính xác, tên chứa cả cụm, rồi theo bm25 (ưu tiên cột tên)
+    
+    Args:
+        query (str): chuỗi tìm kiếm
+        student_class (str, optional): chỉ tìm trong lớp này
+        limit (int, optional): số kết quả tối đa
+    
+    Returns:
+        list[Student]
+    """
+    folded = fold_search_text(query)
+    if not folded:
+        return []
+    
+    if not ensure_student_search_index():
+        q = Student.query.filter(or_(Student.name.ilike(f"%{query}%"), Student.student_code.ilike(f"%{query}%")))
+        if student_class:
+            q = q.filter_by(student_class=student_class)
+        return q.order_by(Student.student_code.asc()).limit(limit).all()
+    
+    # Từ >= 3 ký tự dùng chỉ mục trigram (MATCH), từ ngắn hơn lọc theo đầu từ bằng LIKE trên bảng FTS
+    params = {"q": folded}
+    conditions = []
+    phrases = []
+    for i, token in enumerate(folded.split()):
+        if len(token) >= 3:
+            phrases.append('"' + token.replace('"', '""') + '"')
+        else:
+            params[f"t{i}"] = f"% {token}%"
+            conditions.append(f"(' ' || name || ' ' || code || ' ' || class) LIKE :t{i}")
+    if phrases:
+        params["match"] = " AND ".join(phrases)
+        conditions.append("student_search MATCH :match")
+    if student_class:
+        params["student_class"] = student_class
+        conditions.append("rowid IN (SELECT id FROM student WHERE student_class = :student_class)")
+    
+    sql = (
+        "SELECT rowid FROM student_search WHERE " + " AND ".join(conditions) +
+        " ORDER BY (name = :q) DESC, instr(name, :q) > 0 DESC, " +
+        ("bm25(student_search, 10.0, 5.0, 1.0)" if phrases else "name") + ", rowid"
+    )
+    if limit:
+        sql += " LIMIT :limit"
+        params["limit"] = limit
+    ids = [r[0] for r in db.session.execute(text(sql), params)]
+    if not ids:
+        return []
+    
+    students = {s.id: s for s in Student.query.filter(Student.id.in_(ids)).all()}
+    return [students[i] for i in ids if i in students]
+
+# === OCR HELPER FUNCTIONS ===
+
+OCR_PROMPT = """
+    Hãy đọc THÔNG TIN HỌC SINH từ thẻ trong ảnh này.
+    
+    Trích xuất các thông tin sau (nếu có):
+    - Tên học sinh (họ và tên đầy đủ)
+    - Lớp (ví dụ: 12 Tin, 11A1, 10B, 12TOAN)
+    - Mã số học sinh (nếu có, ví dụ: 12TIN-001, HS123)
+    
+    Trả về JSON với format:
+    {
+        "name": "tên đầy đủ của học sinh",
+        "class": "tên lớp",
+        "student_code": "mã số nếu có, nếu không có để rỗng"
+    }
+    
+    Lưu ý: 
+    - Tên có thể có hoặc không có dấu
+    - Lớp có thể viết liền hoặc có dấu cách (12Tin, 12 Tin)
+    - Nếu không đọc được thông tin nào, trả về chuỗi rỗng ""
+    """
+
+# Ảnh thẻ được thu nhỏ (cạnh dài tối đa, px) và nén lại JPEG trước khi gửi cho model
+OCR_MAX_IMAGE_SIDE = int(os.environ.get("OCR_MAX_IMAGE_SIDE", "1600"))
+OCR_JPEG_QUALITY = int(os.environ.get("OCR_JPEG_QUALITY", "85"))
+# Phiên bản prompt/model/tiền xử lý: đổi một trong số đó thì cache OCR cũ tự động không còn khớp
+OCR_PROMPT_VERSION = hashlib.sha256(
+    f"{OLLAMA_MODEL}\n{OCR_PROMPT}\n{OCR_MAX_IMAGE_SIDE}:{OCR_JPEG_QUALITY}".encode("utf-8")
+).hexdigest()[:12]
+# Số kết quả OCR giữ trong cache (LRU, lưu cả trong CSDL để còn sau khi khởi động lại)
+OCR_CACHE_SIZE = 1000
+
+# Pool dùng chung cho mọi request upload_ocr nên tổng số ảnh gửi tới Ollama cùng lúc luôn bị giới hạn
+_ocr_executor = ThreadPoolExecutor(max_workers=OLLAMA_MAX_CONCURRENCY, thread_name_prefix="ocr")
+
+_ocr_cache = OrderedDict()
+_ocr_cache_state = {"loaded": False}
+_ocr_cache_stats = {"hits": 0, "misses": 0}
+_ocr_cache_lock = threading.Lock()
+
+def ocr_cache_key(image_bytes):
+    """Khóa cache OCR: sha256 nội dung ảnh + phiên bản prompt"""
+    return f"{hashlib.sha256(image_bytes).hexdigest()}:{OCR_PROMPT_VERSION}"
+
+def _load_ocr_cache():
+    """Nạp các kết quả dùng gần nhất từ CSDL vào bộ nhớ (một lần mỗi process)"""
+    if _ocr_cache_state["loaded"]:
+        return
+    rows = OcrCache.query.order_by(OcrCache.last_used_at.desc()).limit(OCR_CACHE_SIZE).all()
+    with _ocr_cache_lock:
+        for row in reversed(rows):
+            _ocr_cache[row.key] = json.loads(row.result)
+        _ocr_cache_state["loaded"] = True
+
+def get_ocr_cache(key):
+    """
+    Lấy kết quả OCR đã cache
+    
+    Returns:
+        dict | None: dữ liệu OCR đã parse, None nếu chưa có
+    """
+    _load_ocr_cache()
+    with _ocr_cache_lock:
+        data = _ocr_cache.get(key)
+        if data is not None:
+            _ocr_cache.move_to_end(key)
+    
+    if data is None:
+        # Có thể do worker khác vừa ghi vào CSDL
+        row = db.session.get(OcrCache, key)
+        if row:
+            data = json.loads(row.result)
+            with _ocr_cache_lock:
+                _ocr_cache[key] = data
+    
+    with _ocr_cache_lock:
+        _ocr_cache_stats["hits" if data is not None else "misses"] += 1
+    if data is not None:
+        OcrCache.query.filter_by(key=key).update({"last_used_at": datetime.datetime.utcnow()})
+        db.session.commit()
+        return dict(data)
+    return None
+
+def put_ocr_cache(key, data):
+    """Lưu kết quả OCR vào cache, loại bỏ kết quả ít dùng nhất khi vượt OCR_CACHE_SIZE"""
+    _load_ocr_cache()
+    with _ocr_cache_lock:
+        _ocr_cache[key] = data
+        _ocr_cache.move_to_end(key)
+        evicted = []
+        while len(_ocr_cache) > OCR_CACHE_SIZE:
+            evicted.append(_ocr_cache.popitem(last=False)[0])
+    
+    try:
+        db.session.merge(OcrCache(
+            key=key,
+            result=json.dumps(data, ensure_ascii=False),
+            last_used_at=datetime.datetime.utcnow()
+        ))
+        if evicted:
+            OcrCache.query.filter(OcrCache.key.in_(evicted)).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"OCR Cache Error: {e}")
+
+def _find_card_box(img):
+    """
+    Ước lượng vùng thẻ: phần ảnh khác màu nền (lấy theo viền ảnh)
+    
+    Returns:
+        tuple | None: (left, top, right, bottom) theo tọa độ ảnh gốc, None nếu không tách được
+    """
+    small = img.convert("L")
+    small.thumbnail((256, 256))
+    w, h = small.size
+    border = [small.getpixel((x, y)) for x in range(w) for y in (0, h - 1)] + \
+             [small.getpixel((x, y)) for y in range(h) for x in (0, w - 1)]
+    background = sorted(border)[len(border) // 2]
+    if ImageStat.Stat(small).stddev[0] < 10:
+        return None
+    
+    diff = ImageChops.difference(small, Image.new("L", small.size, background)).point(lambda v: 255 if v > 40 else 0)
+    box = diff.getbbox()
+    if not box:
+        return None
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    # Vùng quá nhỏ (nhiễu) hoặc gần như cả ảnh (không có nền rõ ràng) thì không cắt
+    if area < 0.2 * w * h or area > 0.9 * w * h:
+        return None
+    
+    scale_x, scale_y = img.width / w, img.height / h
+    pad = 4
+    return (
+        max(0, int((box[0] - pad) * scale_x)), max(0, int((box[1] - pad) * scale_y)),
+        min(img.width, int((box[2] + pad) * scale_x)), min(img.height, int((box[3] + pad) * scale_y))
     )
 
+def prepare_card_image(image_bytes):
+    """
+    Tiền xử lý ảnh thẻ trong bộ nhớ: xoay theo EXIF, cắt vùng thẻ (nếu tách được khỏi nền),
+    thu nhỏ về OCR_MAX_IMAGE_SIDE và nén JPEG. Ảnh lỗi (không đọc được) thì giữ nguyên
+    
+    Returns:
+        tuple: (bytes gửi cho model, info {"original_bytes", "sent_bytes", "cropped", "width", "height"})
+    """
+    info = {"original_bytes": len(image_bytes), "sent_bytes": len(image_bytes), "cropped": False}
+    try:
+        with Image.open(BytesIO(image_bytes)) as src:
+            img = ImageOps.exif_transpose(src).convert("RGB")
+        
+        box = _find_card_box(img)
+        if box:
+            img = img.crop(box)
+            info["cropped"] = True
+        img.thumbnail((OCR_MAX_IMAGE_SIDE, OCR_MAX_IMAGE_SIDE))
+        
+        output = BytesIO()
+        img.save(output, format="JPEG", quality=OCR_JPEG_QUALITY, optimize=True)
+        info["width"], info["height"] = img.size
+        # Ảnh nhỏ sẵn thì nén lại có thể còn lớn hơn: giữ bản gốc
+        if output.tell() < len(image_bytes) or info["cropped"]:
+            image_bytes = output.getvalue()
+    except Exception as e:
+        print(f"Image Preprocess Error: {e}")
+    
+    info["sent_bytes"] = len(image_bytes)
+    return image_bytes, info
+
+def _ocr_read_card(image_bytes, prompt):
+    """
+    Đọc một ảnh thẻ bằng model vision (chạy trong _ocr_executor)
+    Ảnh được xử lý hoàn toàn trong bộ nhớ, không ghi ra UPLOAD_FOLDER
+    
+    Returns:
+        tuple: (data, error, seconds, image info)
+    """
+    started = time.perf_counter()
+    image_bytes, image_info = prepare_card_image(image_bytes)
+    data, error = _call_gemini(prompt, is_json=True, image_bytes=image_bytes)
+    return data, error, time.perf_counter() - started, image_info
 
 @app.route("/upload_ocr", methods=["POST"])
 @login_required
@@ -752,134 +2709,34 @@ def upload_ocr():
     if not uploaded_files: return jsonify({"error": "Chưa chọn file."})
 
     results = []
-    
-    prompt = """
-    Hãy đọc THÔNG TIN HỌC SINH từ thẻ trong ảnh này.
-    
-    Trích xuất các thông tin sau (nếu có):
-    - Tên học sinh (họ và tên đầy đủ)
-    - Lớp (ví dụ: 12 Tin, 11A1, 10B, 12TOAN)
-    - Mã số học sinh (nếu có, ví dụ: 12TIN-001, HS123)
-    
-    Trả về JSON với format:
-    {
-        "name": "tên đầy đủ của học sinh",
-        "class": "tên lớp",
-        "student_code": "mã số nếu có, nếu không có để rỗng"
-    }
-    
-    Lưu ý: 
-    - Tên có thể có hoặc không có dấu
-    - Lớp có thể viết liền hoặc có dấu cách (12Tin, 12 Tin)
-    - Nếu không đọc được thông tin nào, trả về chuỗi rỗng ""
-    """
 
-    def normalize_text(text):
-        """Chuẩn hóa text: loại bỏ dấu cách thừa, chuyển thành chữ thường"""
-        import unicodedata
-        if not text:
-            return ""
-        # Loại bỏ dấu cách thừa
-        text = " ".join(text.split())
-        # Chuyển thành chữ thường
-        return text.lower().strip()
-    
-    def remove_accents(text):
-        """Loại bỏ dấu tiếng Việt"""
-        if not text:
-            return ""
-        # Chuẩn hóa Unicode về dạng NFD (tách dấu)
-        nfd = unicodedata.normalize('NFD', text)
-        # Loại bỏ các ký tự dấu
-        return ''.join(char for char in nfd if unicodedata.category(char) != 'Mn')
-    
-    def fuzzy_match_students(ocr_name, ocr_class, ocr_code):
-        """Tìm học sinh phù hợp nhất với thông tin OCR"""
-        candidates = []
-        
-        # Chuẩn hóa input
-        ocr_name_norm = normalize_text(ocr_name)
-        ocr_name_no_accent = remove_accents(ocr_name_norm)
-        ocr_class_norm = normalize_text(ocr_class)
-        
-        # Lấy tất cả học sinh
-        all_students = Student.query.all()
-        
-        for student in all_students:
-            score = 0
-            reasons = []
-            
-            # So sánh mã số nếu có
-            if ocr_code and student.student_code:
-                if ocr_code.upper() == student.student_code.upper():
-                    score += 100  # Match chính xác mã số = điểm cao nhất
-                    reasons.append("Mã số khớp chính xác")
-                elif ocr_code.upper() in student.student_code.upper() or student.student_code.upper() in ocr_code.upper():
-                    score += 50
-                    reasons.append("Mã số khớp một phần")
-            
-            # So sánh lớp
-            student_class_norm = normalize_text(student.student_class)
-            if ocr_class_norm and student_class_norm:
-                # Loại bỏ khoảng cách để so sánh (12Tin == 12 Tin)
-                ocr_class_no_space = ocr_class_norm.replace(" ", "")
-                student_class_no_space = student_class_norm.replace(" ", "")
-                
-                if ocr_class_no_space == student_class_no_space:
-                    score += 40
-                    reasons.append("Lớp khớp chính xác")
-                elif ocr_class_no_space in student_class_no_space or student_class_no_space in ocr_class_no_space:
-                    score += 20
-                    reasons.append("Lớp khớp một phần")
-            
-            # So sánh tên
-            student_name_norm = normalize_text(student.name)
-            student_name_no_accent = remove_accents(student_name_norm)
-            
-            if ocr_name_norm and student_name_norm:
-                # So sánh có dấu
-                if ocr_name_norm == student_name_norm:
-                    score += 60
-                    reasons.append("Tên khớp chính xác (có dấu)")
-                # So sánh không dấu
-                elif ocr_name_no_accent == student_name_no_accent:
-                    score += 50
-                    reasons.append("Tên khớp chính xác (không dấu)")
-                # So sánh chứa
-                elif ocr_name_norm in student_name_norm or student_name_norm in ocr_name_norm:
-                    score += 30
-                    reasons.append("Tên khớp một phần (có dấu)")
-                elif ocr_name_no_accent in student_name_no_accent or student_name_no_accent in ocr_name_no_accent:
-                    score += 25
-                    reasons.append("Tên khớp một phần (không dấu)")
-                # Sử dụng difflib để tính similarity
-                else:
-                    from difflib import SequenceMatcher
-                    ratio = SequenceMatcher(None, ocr_name_no_accent, student_name_no_accent).ratio()
-                    if ratio > 0.7:  # 70% giống nhau
-                        score += int(ratio * 30)
-                        reasons.append(f"Tên tương tự {int(ratio*100)}%")
-            
-            if score > 0:
-                candidates.append({
-                    "student": student,
-                    "score": score,
-                    "reasons": reasons
-                })
-        
-        # Sắp xếp theo điểm giảm dần
-        candidates.sort(key=lambda x: x["score"], reverse=True)
-        
-        # Trả về top 3
-        return candidates[:3]
+    # Ảnh đã đọc trước đó (cùng nội dung, cùng prompt) lấy từ cache;
+    # ảnh còn lại gửi vào pool OCR (song song, có giới hạn), kết quả giữ đúng thứ tự upload
+    started = time.perf_counter()
+    files = [(f.filename, f.read()) for f in uploaded_files if f.filename != '']
+    keys = [ocr_cache_key(content) for _, content in files]
+    cached = {}
+    futures = {}
+    for (_, content), key in zip(files, keys):
+        if key in cached or key in futures:
+            continue
+        data = get_ocr_cache(key)
+        if data is not None:
+            cached[key] = data
+        else:
+            futures[key] = _ocr_executor.submit(_ocr_read_card, content, OCR_PROMPT)
 
-    for f in uploaded_files:
-        if f.filename == '': continue
-        p = os.path.join(UPLOAD_FOLDER, f.filename)
-        f.save(p)
-        
-        data, error = _call_gemini(prompt, image_path=p, is_json=True)
-        if os.path.exists(p): os.remove(p)
+    for (filename, content), key in zip(files, keys):
+        from_cache = key in cached
+        if from_cache:
+            data, error, ocr_seconds = cached[key], None, 0.0
+            image_info = {"original_bytes": len(content), "sent_bytes": 0, "cropped": False}
+        else:
+            data, error, ocr_seconds, image_info = futures[key].result()
+            if data and isinstance(data, dict):
+                put_ocr_cache(key, data)
+                cached[key] = data
+        match_started = time.perf_counter()
 
         if data:
             ocr_name = str(data.get("name", "")).strip()
@@ -895,7 +2752,7 @@ def upload_ocr():
                 student = best_match["student"]
                 
                 item = {
-                    "file_name": f.filename,
+                    "file_name": filename,
                     "ocr_data": {
                         "name": ocr_name,
                         "class": ocr_class,
@@ -922,7 +2779,7 @@ def upload_ocr():
                 }
             else:
                 item = {
-                    "file_name": f.filename,
+                    "file_name": filename,
                     "ocr_data": {
                         "name": ocr_name,
                         "class": ocr_class,
@@ -931,12 +2788,18 @@ def upload_ocr():
                     "found": False,
                     "db_info": None
                 }
-            
-            results.append(item)
         else:
-            results.append({"file_name": f.filename, "error": error or "Không đọc được thông tin từ thẻ"})
+            item = {"file_name": filename, "error": error or "Không đọc được thông tin từ thẻ"}
+
+        item["cached"] = from_cache
+        item["image"] = image_info
+        item["timing"] = {
+            "ocr_seconds": round(ocr_seconds, 3),
+            "match_seconds": round(time.perf_counter() - match_started, 3)
+        }
+        results.append(item)
 
-    return jsonify({"results": results})
+    return jsonify({"results": results, "elapsed_seconds": round(time.perf_counter() - started, 3)})
 
 @app.route("/batch_violation", methods=["POST"])
 def batch_violation(): return redirect(url_for('add_violation'))
@@ -955,6 +2818,8 @@ def manage_students():
 def add_student():
     db.session.add(Student(name=request.form["student_name"], student_code=request.form["student_code"], student_class=request.form["student_class"]))
     db.session.commit()
+    invalidate_class_stats(classes=[request.form["student_class"]])
+    invalidate_student_index()
     flash("Thêm học sinh thành công", "success")
     return redirect(url_for("manage_students"))
 
@@ -963,9 +2828,13 @@ def add_student():
 def delete_student(student_id):
     s = db.session.get(Student, student_id)
     if s:
+        weeks = [w for (w,) in db.session.query(Violation.week_number).filter_by(student_id=student_id).distinct()]
         Violation.query.filter_by(student_id=student_id).delete()
         db.session.delete(s)
+        prune_violation_weeks(weeks)
         db.session.commit()
+        invalidate_class_stats(classes=[s.student_class])
+        invalidate_student_index()
         flash("Đã xóa học sinh", "success")
     return redirect(url_for("manage_students"))
 
@@ -978,10 +2847,13 @@ def edit_student(student_id):
         return redirect(url_for("manage_students"))
         
     if request.method == "POST":
+        old_class = s.student_class
         s.name = request.form["student_name"]
         s.student_code = request.form["student_code"]
         s.student_class = request.form["student_class"]
         db.session.commit()
+        invalidate_class_stats(classes=[old_class, s.student_class])
+        invalidate_student_index()
         flash("Cập nhật thành công", "success")
         return redirect(url_for("manage_students"))
         
@@ -993,6 +2865,7 @@ def add_class():
     if not ClassRoom.query.filter_by(name=request.form["class_name"]).first():
         db.session.add(ClassRoom(name=request.form["class_name"]))
         db.session.commit()
+        invalidate_global_context()
     return redirect(url_for("manage_students"))
 #chỉnh sửa lớp học
 
@@ -1021,6 +2894,9 @@ def edit_class(class_id):
                 s.student_class = new_name
                 
             db.session.commit()
+            invalidate_class_stats(classes=[old_name, new_name])
+            invalidate_student_index()
+            invalidate_global_context()
             flash(f"Đã đổi tên lớp '{old_name}' thành '{new_name}' và cập nhật {len(students_in_class)} học sinh.", "success")
         else:
             flash("Không tìm thấy lớp học!", "error")
@@ -1045,6 +2921,7 @@ def delete_class(class_id):
             else:
                 db.session.delete(cls)
                 db.session.commit()
+                invalidate_global_context()
                 flash(f"Đã xóa lớp {cls.name}", "success")
     except Exception as e:
         flash(f"Lỗi: {str(e)}", "error")
@@ -1086,8 +2963,14 @@ def chatbot():
 @app.route("/api/chatbot", methods=["POST"])
 @login_required
 def api_chatbot():
-    """Context-aware chatbot với conversation memory"""
+    """
+    Context-aware chatbot với conversation memory
+    
+    Gửi "stream": true để nhận câu trả lời AI dạng text/event-stream (xem stream_chat_response);
+    các câu trả lời không cần AI (danh sách học sinh, lỗi nhập liệu) vẫn trả về JSON.
+    """
     msg = (request.json.get("message") or "").strip()
+    stream = bool(request.json.get("stream"))
     if not msg:
         return jsonify({"response": "Vui lòng nhập câu hỏi."})
     
@@ -1102,12 +2985,7 @@ def api_chatbot():
     save_message(session_id, teacher_id, "user", msg)
     
     # 4. Tìm kiếm học sinh từ CSDL (hỗ trợ cả context từ history)
-    s_list = Student.query.filter(
-        or_(
-            Student.name.ilike(f"%{msg}%"), 
-            Student.student_code.ilike(f"%{msg}%")
-        )
-    ).limit(5).all()
+    s_list = search_students(msg, limit=5)
     
     # Nếu tìm thấy học sinh
     if s_list:
@@ -1140,41 +3018,14 @@ def api_chatbot():
         school_year = "2023-2024"
         
         # Lấy điểm học tập
-        grades = Grade.query.filter_by(
-            student_id=student.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
-        
         grades_data = {}
-        if grades:
-            grades_by_subject = {}
-            for grade in grades:
-                if grade.subject_id not in grades_by_subject:
-                    grades_by_subject[grade.subject_id] = {
-                        'subject_name': grade.subject.name,
-                        'TX': [],
-                        'GK': [],
-                        'HK': []
-                    }
-                grades_by_subject[grade.subject_id][grade.grade_type].append(grade.score)
-            
-            for subject_id, data in grades_by_subject.items():
-                subject_name = data['subject_name']
-                avg_score = None
-                
-                if data['TX'] and data['GK'] and data['HK']:
-                    avg_tx = sum(data['TX']) / len(data['TX'])
-                    avg_gk = sum(data['GK']) / len(data['GK'])
-                    avg_hk = sum(data['HK']) / len(data['HK'])
-                    avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-                    
-                    grades_data[subject_name] = {
-                        'TX': round(avg_tx, 1),
-                        'GK': round(avg_gk, 1),
-                        'HK': round(avg_hk, 1),
-                        'TB': avg_score
-                    }
+        for item in build_transcript(student.id, semester, school_year).graded_subjects:
+            grades_data[item.subject.name] = {
+                'TX': round(item.avg_tx, 1),
+                'GK': round(item.avg_gk, 1),
+                'HK': round(item.avg_hk, 1),
+                'TB': item.avg_score
+            }
         
         # Lấy vi phạm
         violations = Violation.query.filter_by(student_id=student.id).order_by(Violation.date_committed.desc()).all()
@@ -1237,52 +3088,47 @@ Dựa trên lịch sử hội thoại và thông tin học sinh, hãy:
 Trả lời bằng tiếng Việt, thân thiện, chuyên nghiệp. Sử dụng emoji phù hợp và định dạng markdown.
 """
         
+        # Tạo các nút hành động
+        buttons = [
+            {"label": "📊 Xem học bạ", "payload": f"/student/{student.id}/transcript"},
+            {"label": "📈 Chi tiết điểm", "payload": f"/student/{student.id}"},
+            {"label": "📜 Lịch sử vi phạm", "payload": f"/student/{student.id}/violations_timeline"}
+        ]
+        
+        # Fallback nếu AI lỗi - hiển thị dữ liệu raw
+        response = f"**📋 Thông tin học sinh**\n\n"
+        response += f"**Họ tên:** {student.name}\n"
+        response += f"**Mã số:** {student.student_code}\n"
+        response += f"**Lớp:** {student.student_class}\n"
+        response += f"**Điểm hành vi:** {student.current_score}/100\n\n"
+        
+        if grades_data:
+            response += "**📚 Điểm học tập (HK1):**\n"
+            for subject, scores in grades_data.items():
+                response += f"• {subject}: TX={scores['TX']}, GK={scores['GK']}, HK={scores['HK']}, TB={scores['TB']}\n"
+            response += "\n"
+        
+        if violations_data:
+            response += f"**⚠️ Vi phạm:** {len(violations)} lần\n"
+            response += "**Gần nhất:**\n"
+            for v in violations_data[:3]:
+                response += f"• {v['type']} (-{v['points']}đ) - {v['date']}\n"
+        else:
+            response += "**✅ Không có vi phạm**\n"
+        
+        context_data = {"student_id": student.id, "student_name": student.name}
+        if stream:
+            return stream_chat_response(prompt, session_id, teacher_id, response, buttons, context_data)
+        
         ai_response, err = _call_gemini(prompt)
         
         if ai_response:
             # Save AI response
-            save_message(session_id, teacher_id, "assistant", ai_response, 
-                        context_data={"student_id": student.id, "student_name": student.name})
-            
-            # Tạo các nút hành động
-            buttons = [
-                {"label": "📊 Xem học bạ", "payload": f"/student/{student.id}/transcript"},
-                {"label": "📈 Chi tiết điểm", "payload": f"/student/{student.id}"},
-                {"label": "📜 Lịch sử vi phạm", "payload": f"/student/{student.id}/violations_timeline"}
-            ]
-            
+            save_message(session_id, teacher_id, "assistant", ai_response, context_data=context_data)
             return jsonify({"response": ai_response.strip(), "buttons": buttons})
-        else:
-            # Fallback nếu AI lỗi - hiển thị dữ liệu raw
-            response = f"**📋 Thông tin học sinh**\n\n"
-            response += f"**Họ tên:** {student.name}\n"
-            response += f"**Mã số:** {student.student_code}\n"
-            response += f"**Lớp:** {student.student_class}\n"
-            response += f"**Điểm hành vi:** {student.current_score}/100\n\n"
-            
-            if grades_data:
-                response += "**📚 Điểm học tập (HK1):**\n"
-                for subject, scores in grades_data.items():
-                    response += f"• {subject}: TX={scores['TX']}, GK={scores['GK']}, HK={scores['HK']}, TB={scores['TB']}\n"
-                response += "\n"
-            
-            if violations_data:
-                response += f"**⚠️ Vi phạm:** {len(violations)} lần\n"
-                response += "**Gần nhất:**\n"
-                for v in violations_data[:3]:
-                    response += f"• {v['type']} (-{v['points']}đ) - {v['date']}\n"
-            else:
-                response += "**✅ Không có vi phạm**\n"
-            
-            save_message(session_id, teacher_id, "assistant", response)
-            
-            buttons = [
-                {"label": "📊 Xem học bạ", "payload": f"/student/{student.id}/transcript"},
-                {"label": "📈 Chi tiết điểm", "payload": f"/student/{student.id}"},
-                {"label": "📜 Lịch sử vi phạm", "payload": f"/student/{student.id}/violations_timeline"}
-            ]
-            
-            return jsonify({"response": response.strip(), "buttons": buttons})
+        
+        save_message(session_id, teacher_id, "assistant", response)
+        return jsonify({"response": response.strip(), "buttons": buttons})
     
     # Nếu không tìm thấy học sinh, sử dụng AI với context awareness
     prompt = f"""{CHATBOT_SYSTEM_PROMPT}
@@ -1306,8 +3152,12 @@ Bạn là trợ lý ảo của hệ thống quản lý học sinh.
 - Trả lời ngắn gọn, thân thiện, sử dụng emoji và markdown
 """
     
+    fallback_text = "Xin lỗi, tôi chưa hiểu câu hỏi của bạn. Bạn có thể nhập tên hoặc mã số học sinh để tra cứu thông tin."
+    if stream:
+        return stream_chat_response(prompt, session_id, teacher_id, fallback_text)
+    
     ans, err = _call_gemini(prompt)
-    response_text = ans or "Xin lỗi, tôi chưa hiểu câu hỏi của bạn. Bạn có thể nhập tên hoặc mã số học sinh để tra cứu thông tin."
+    response_text = ans or fallback_text
     
     # Save AI response
     save_message(session_id, teacher_id, "assistant", response_text)
@@ -1339,7 +3189,7 @@ def edit_profile():
 @login_required
 def history():
     # Lấy danh sách tuần
-    weeks = [w[0] for w in db.session.query(Violation.week_number).distinct().order_by(Violation.week_number.desc()).all()]
+    weeks = get_violation_weeks()
     
     selected_week = request.args.get('week', type=int)
     selected_class = request.args.get('class_select', '').strip()
@@ -1387,25 +3237,17 @@ def history():
 
         # D. TÍNH BẢNG XẾP HẠNG (Chỉ tính khi không lọc lớp cụ thể)
         if not selected_class:
-            all_classes_obj = ClassRoom.query.all()
-            for cls in all_classes_obj:
+            for cls in get_class_rankings(selected_week):
                 # Lấy điểm trung bình từ Archive cho nhanh
-                cls_avgs = [a.final_score for a in WeeklyArchive.query.filter_by(week_number=selected_week, student_class=cls.name).all()]
-                
-                # Tính tổng lỗi (để hiển thị)
-                deduct = db.session.query(func.sum(Violation.points_deducted))\
-                    .join(Student).filter(Student.student_class == cls.name, Violation.week_number == selected_week).scalar() or 0
-                
-                avg_score = sum(cls_avgs)/len(cls_avgs) if cls_avgs else 100
-                
+                avg_score = cls["archived_avg"] if cls["archived_avg"] is not None else 100
                 class_rankings.append({
-                    "name": cls.name,
-                    "weekly_deduct": deduct,
+                    "name": cls["name"],
+                    "weekly_deduct": cls["weekly_deduct"],
                     "avg_score": round(avg_score, 2)
                 })
             class_rankings.sort(key=lambda x: x['avg_score'], reverse=True)
 
-    all_classes = [c.name for c in ClassRoom.query.order_by(ClassRoom.name).all()]
+    all_classes = get_global_context()["classes"]
 
     return render_template("history.html", 
                            weeks=weeks, 
@@ -1421,6 +3263,55 @@ def history():
 
 # --- THÊM ROUTE MỚI ĐỂ XUẤT EXCEL ---
 
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+EXPORT_YIELD_PER = 1000
+
+def write_excel_stream(rows, columns, sheet_name, empty_message, column_width=None):
+    """
+    Ghi dữ liệu ra file Excel bằng workbook write-only của openpyxl
+    Các dòng được ghi lần lượt từ iterator nên bộ nhớ không tăng theo số dòng
+    
+    Args:
+        rows: iterator các tuple theo thứ tự columns
+        columns (list): Tên cột
+        sheet_name (str): Tên sheet
+        empty_message (str): Nội dung cột "Thông báo" khi không có dữ liệu
+        column_width (int, optional): Độ rộng cột
+    
+    Returns:
+        file object (file tạm, đã seek về đầu)
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_name)
+    
+    def header(names):
+        cells = []
+        for name in names:
+            cell = WriteOnlyCell(ws, value=name)
+            cell.font = Font(bold=True)
+            cells.append(cell)
+        return cells
+    
+    if column_width:
+        for idx in range(len(columns)):
+            ws.column_dimensions[chr(65 + idx)].width = column_width
+    
+    has_rows = False
+    for row in rows:
+        if not has_rows:
+            ws.append(header(columns))
+            has_rows = True
+        ws.append(tuple(row))
+    
+    if not has_rows:
+        ws.append(header(["Thông báo"]))
+        ws.append([empty_message])
+    
+    output = tempfile.TemporaryFile()
+    wb.save(output)
+    output.seek(0)
+    return output
+
 @app.route("/export_history")
 @login_required
 def export_history():
@@ -1431,47 +3322,40 @@ def export_history():
         flash("Vui lòng chọn tuần để xuất báo cáo", "error")
         return redirect(url_for('history'))
 
-    # Truy vấn giống hệt bên trên
-    query = db.session.query(Violation).join(Student).filter(Violation.week_number == selected_week)
+    # Truy vấn giống hệt bên trên (chỉ lấy các cột cần thiết, đọc theo từng lô)
+    query = db.session.query(
+        Violation.date_committed,
+        Student.student_code,
+        Student.name,
+        Student.student_class,
+        Violation.violation_type_name,
+        Violation.points_deducted,
+        Violation.week_number
+    ).join(Student, Violation.student_id == Student.id).filter(Violation.week_number == selected_week)
     if selected_class:
         query = query.filter(Student.student_class == selected_class)
     
-    violations = query.order_by(Violation.date_committed.desc()).all()
-    
-    # Tạo dữ liệu cho Excel
-    data = []
-    for v in violations:
-        data.append({
-            "Ngày": v.date_committed.strftime('%d/%m/%Y'),
-            "Mã HS": v.student.student_code,
-            "Họ Tên": v.student.name,
-            "Lớp": v.student.student_class,
-            "Lỗi Vi Phạm": v.violation_type_name,
-            "Điểm Trừ": v.points_deducted,
-            "Tuần": v.week_number
-        })
+    query = query.order_by(Violation.date_committed.desc()).yield_per(EXPORT_YIELD_PER)
+    
+    rows = (
+        (date.strftime('%d/%m/%Y') if date else "", code, name, s_class, v_type, points, week)
+        for date, code, name, s_class, v_type, points, week in query
+    )
     
     # Xuất file
-    if data:
-        df = pd.read_json(json.dumps(data))
-    else:
-        df = pd.DataFrame([{"Thông báo": "Không có dữ liệu vi phạm"}])
-
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name=f"Tuan_{selected_week}")
-        # Tự động điều chỉnh độ rộng cột (cơ bản)
-        worksheet = writer.sheets[f"Tuan_{selected_week}"]
-        for idx, col in enumerate(df.columns):
-            worksheet.column_dimensions[chr(65 + idx)].width = 20
-
-    output.seek(0)
+    output = write_excel_stream(
+        rows,
+        ["Ngày", "Mã HS", "Họ Tên", "Lớp", "Lỗi Vi Phạm", "Điểm Trừ", "Tuần"],
+        sheet_name=f"Tuan_{selected_week}",
+        empty_message="Không có dữ liệu vi phạm",
+        column_width=20
+    )
     filename = f"BaoCao_ViPham_Tuan{selected_week}"
     if selected_class:
         filename += f"_{selected_class}"
     filename += ".xlsx"
     
-    return send_file(output, download_name=filename, as_attachment=True, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    return send_file(output, download_name=filename, as_attachment=True, mimetype=XLSX_MIMETYPE)
 
 @app.route("/weekly_report")
 @login_required
@@ -1483,24 +3367,17 @@ def weekly_report():
     total_errors = len(vios)
     total_points = sum(v.Violation.points_deducted for v in vios)
     
-    all_classes = ClassRoom.query.all()
     class_data = []
     
-    for cls in all_classes:
-        students_in_class = Student.query.filter_by(student_class=cls.name).all()
-        
-        if not students_in_class:
+    for cls in get_class_rankings(sel):
+        if not cls["student_count"]:
             continue
         
-        weekly_deduct = db.session.query(func.sum(Violation.points_deducted))\
-            .join(Student)\
-            .filter(Student.student_class == cls.name, Violation.week_number == sel)\
-            .scalar() or 0
-        
+        weekly_deduct = cls["weekly_deduct"]
         avg_score = 100 - weekly_deduct
         
         class_data.append({
-            'name': cls.name,
+            'name': cls["name"],
             'avg_score': round(avg_score, 1),
             'weekly_deduct': round(weekly_deduct, 1)
         })
@@ -1515,13 +3392,198 @@ def weekly_report():
 def export_report():
     week = request.args.get('week', type=int)
     if not week: return "Vui lòng chọn tuần", 400
-    violations = db.session.query(Violation, Student).join(Student).filter(Violation.week_number == week).all()
-    data = [{"Tên": r.Student.name, "Lớp": r.Student.student_class, "Lỗi": r.Violation.violation_type_name} for r in violations]
-    df = pd.read_json(json.dumps(data)) if data else pd.DataFrame([{"Thông báo": "Trống"}])
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer: df.to_excel(writer, index=False)
+    rows = db.session.query(Student.name, Student.student_class, Violation.violation_type_name)\
+        .join(Student, Violation.student_id == Student.id)\
+        .filter(Violation.week_number == week).yield_per(EXPORT_YIELD_PER)
+    output = write_excel_stream(rows, ["Tên", "Lớp", "Lỗi"], sheet_name="Sheet1", empty_message="Trống")
+    return send_file(output, download_name=f"Report_{week}.xlsx", as_attachment=True, mimetype=XLSX_MIMETYPE)
+
+# --- XUẤT DỮ LIỆU CSV (GZIP) / PARQUET CHO PHÂN TÍCH ---
+
+EXPORT_CHUNK_SIZE = 5000
+
+# Mỗi bộ dữ liệu: danh sách (tên cột, cột SQLAlchemy, kiểu dữ liệu)
+EXPORT_DATASETS = {
+    "violations": [
+        ("id", Violation.id, "int"),
+        ("student_id", Violation.student_id, "int"),
+        ("student_code", Student.student_code, "str"),
+        ("student_name", Student.name, "str"),
+        ("student_class", Student.student_class, "str"),
+        ("violation_type_name", Violation.violation_type_name, "str"),
+        ("points_deducted", Violation.points_deducted, "int"),
+        ("date_committed", Violation.date_committed, "datetime"),
+        ("week_number", Violation.week_number, "int"),
+    ],
+    "grades": [
+        ("id", Grade.id, "int"),
+        ("student_id", Grade.student_id, "int"),
+        ("student_code", Student.student_code, "str"),
+        ("student_name", Student.name, "str"),
+        ("student_class", Student.student_class, "str"),
+        ("subject_code", Subject.code, "str"),
+        ("subject_name", Subject.name, "str"),
+        ("grade_type", Grade.grade_type, "str"),
+        ("column_index", Grade.column_index, "int"),
+        ("score", Grade.score, "float"),
+        ("semester", Grade.semester, "int"),
+        ("school_year", Grade.school_year, "str"),
+        ("date_recorded", Grade.date_recorded, "datetime"),
+    ],
+    "weekly_archive": [
+        ("id", WeeklyArchive.id, "int"),
+        ("week_number", WeeklyArchive.week_number, "int"),
+        ("student_id", WeeklyArchive.student_id, "int"),
+        ("student_code", WeeklyArchive.student_code, "str"),
+        ("student_name", WeeklyArchive.student_name, "str"),
+        ("student_class", WeeklyArchive.student_class, "str"),
+        ("final_score", WeeklyArchive.final_score, "int"),
+        ("total_deductions", WeeklyArchive.total_deductions, "int"),
+        ("created_at", WeeklyArchive.created_at, "datetime"),
+    ],
+}
+
+def school_year_range(school_year):
+    """
+    Khoảng thời gian của năm học "2023-2024": 01/08/2023 -> 01/08/2024
+    
+    Returns:
+        tuple(datetime, datetime) hoặc None nếu sai định dạng
+    """
+    match = re.match(r"^(\d{4})-(\d{4})$", school_year or "")
+    if not match:
+        return None
+    start_year, end_year = int(match.group(1)), int(match.group(2))
+    return datetime.datetime(start_year, 8, 1), datetime.datetime(end_year, 8, 1)
+
+def build_export_query(dataset, week=None, s_class=None, school_year=None):
+    """
+    Truy vấn dữ liệu xuất theo bộ lọc tuần / lớp / năm học
+    Năm học: Grade lọc theo cột school_year, Violation/WeeklyArchive lọc theo ngày
+    """
+    columns = [col for _, col, _ in EXPORT_DATASETS[dataset]]
+    q = db.session.query(*columns)
+    
+    if dataset == "violations":
+        q = q.select_from(Violation).join(Student, Violation.student_id == Student.id)
+        if week: q = q.filter(Violation.week_number == week)
+        if s_class: q = q.filter(Student.student_class == s_class)
+        year_range = school_year_range(school_year)
+        if year_range:
+            q = q.filter(Violation.date_committed >= year_range[0], Violation.date_committed < year_range[1])
+        q = q.order_by(Violation.id)
+    elif dataset == "grades":
+        q = q.select_from(Grade).join(Student, Grade.student_id == Student.id).join(Subject, Grade.subject_id == Subject.id)
+        if s_class: q = q.filter(Student.student_class == s_class)
+        if school_year: q = q.filter(Grade.school_year == school_year)
+        q = q.order_by(Grade.id)
+    else:
+        q = q.select_from(WeeklyArchive)
+        if week: q = q.filter(WeeklyArchive.week_number == week)
+        if s_class: q = q.filter(WeeklyArchive.student_class == s_class)
+        year_range = school_year_range(school_year)
+        if year_range:
+            q = q.filter(WeeklyArchive.created_at >= year_range[0], WeeklyArchive.created_at < year_range[1])
+        q = q.order_by(WeeklyArchive.id)
+    
+    return q.yield_per(EXPORT_CHUNK_SIZE)
+
+def iter_csv_gzip(query, header):
+    """Sinh từng khối CSV đã nén gzip từ truy vấn (không giữ toàn bộ dữ liệu trong bộ nhớ)"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    
+    for idx, row in enumerate(query, start=1):
+        writer.writerow(row)
+        if idx % EXPORT_CHUNK_SIZE == 0:
+            chunk = compressor.compress(buffer.getvalue().encode("utf-8"))
+            buffer.seek(0)
+            buffer.truncate()
+            if chunk:
+                yield chunk
+    
+    yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+
+def write_parquet(query, spec):
+    """
+    Ghi truy vấn ra file Parquet theo từng row group (mỗi nhóm EXPORT_CHUNK_SIZE dòng)
+    
+    Returns:
+        file object (file tạm, đã seek về đầu)
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    arrow_types = {"int": pa.int64(), "str": pa.string(), "float": pa.float64(), "datetime": pa.timestamp("us")}
+    schema = pa.schema([(name, arrow_types[kind]) for name, _, kind in spec])
+    names = [name for name, _, _ in spec]
+    
+    output = tempfile.TemporaryFile()
+    writer = pq.ParquetWriter(output, schema, compression="snappy")
+    
+    def flush(rows):
+        columns = list(zip(*rows)) if rows else [[] for _ in names]
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(list(values), type=schema.field(i).type) for i, values in enumerate(columns)],
+            schema=schema
+        ))
+    
+    rows = []
+    written = False
+    for row in query:
+        rows.append(tuple(row))
+        if len(rows) >= EXPORT_CHUNK_SIZE:
+            flush(rows)
+            written = True
+            rows = []
+    if rows or not written:
+        flush(rows)
+    
+    writer.close()
     output.seek(0)
-    return send_file(output, download_name=f"Report_{week}.xlsx", as_attachment=True, mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+    return output
+
+@app.route("/export_data/<dataset>")
+@login_required
+def export_data(dataset):
+    """
+    Xuất toàn bộ dữ liệu Violation / Grade / WeeklyArchive cho phân tích
+    Query params: format (csv|parquet), week, class_select, school_year
+    """
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({"error": f"Bộ dữ liệu không hợp lệ: {dataset}"}), 400
+    
+    fmt = request.args.get("format", "csv").lower()
+    week = request.args.get("week", type=int)
+    s_class = request.args.get("class_select", "").strip()
+    school_year = request.args.get("school_year", "").strip()
+    
+    spec = EXPORT_DATASETS[dataset]
+    filename = dataset
+    if week: filename += f"_tuan{week}"
+    if s_class: filename += f"_{s_class}"
+    if school_year: filename += f"_{school_year}"
+    
+    query = build_export_query(dataset, week, s_class, school_year)
+    
+    if fmt == "csv":
+        header = [name for name, _, _ in spec]
+        return Response(
+            stream_with_context(iter_csv_gzip(query, header)),
+            mimetype="application/gzip",
+            headers={"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}.csv.gz"}
+        )
+    
+    if fmt == "parquet":
+        try:
+            output = write_parquet(query, spec)
+        except ImportError:
+            return jsonify({"error": "Chưa cài đặt pyarrow (pip install pyarrow)"}), 500
+        return send_file(output, download_name=f"{filename}.parquet", as_attachment=True, mimetype="application/vnd.apache.parquet")
+    
+    return jsonify({"error": f"Định dạng không hợp lệ: {fmt}"}), 400
 
 @app.route("/student/<int:student_id>")
 @login_required
@@ -1534,12 +3596,26 @@ def student_detail(student_id):
         pts.append(curr); lbls.append(format_date_vn(v.date_committed))
     return render_template("student_detail.html", student=s, chart_labels=json.dumps(lbls), chart_scores=json.dumps(pts))
 
+def run_student_report(job_id, params):
+    """Job AI: nhận xét ngắn về một học sinh"""
+    s = db.session.get(Student, params["student_id"])
+    ans, error = _call_gemini(
+        f"Nhận xét HS {s.name}. Điểm: {s.current_score}",
+        cache_ttl=LLM_TTL_STUDENT_REPORT, bypass_cache=params.get("regenerate", False)
+    )
+    if error:
+        print(f"Student Report AI Error: {error}")
+        return {"report": f"{s.name} - Điểm rèn luyện hiện tại: {s.current_score}/100. {AI_FALLBACK_NOTE}", "fallback": True}
+    return {"report": ans}
+
 @app.route("/api/generate_report/<int:student_id>", methods=["POST"])
 @login_required
 def generate_report(student_id):
-    s = db.session.get(Student, student_id)
-    ans, _ = _call_gemini(f"Nhận xét HS {s.name}. Điểm: {s.current_score}")
-    return jsonify({"report": ans})
+    if not db.session.get(Student, student_id):
+        return jsonify({"error": "Không tìm thấy học sinh"}), 404
+    data = request.get_json(silent=True) or {}
+    params = {"student_id": student_id, "regenerate": bool(data.get("regenerate"))}
+    return respond_ai_job("student_report", run_student_report, params, wait=not data.get("async"))
 
 
 @app.route("/manage_subjects", methods=["GET", "POST"])
@@ -1619,17 +3695,18 @@ def manage_grades():
     search = request.args.get('search', '').strip()
     selected_class = request.args.get('class_select', '').strip()
     
-    q = Student.query
-    if selected_class:
-        q = q.filter_by(student_class=selected_class)
     if search:
-        q = q.filter(or_(
-            Student.name.ilike(f"%{search}%"),
-            Student.student_code.ilike(f"%{search}%")
-        ))
+        students = search_students(search, student_class=selected_class or None)
+    else:
+        q = Student.query
+        if selected_class:
+            q = q.filter_by(student_class=selected_class)
+        students = q.order_by(Student.student_code.asc()).all()
     
-    students = q.order_by(Student.student_code.asc()).all()
-    return render_template("manage_grades.html", students=students, search_query=search, selected_class=selected_class)
+    semester, school_year = get_current_term()
+    student_gpas = calculate_gpa_batch([s.id for s in students], semester, school_year)
+    
+    return render_template("manage_grades.html", students=students, student_gpas=student_gpas, search_query=search, selected_class=selected_class)
 
 @app.route("/student_grades/<int:student_id>", methods=["GET", "POST"])
 @login_required
@@ -1686,6 +3763,7 @@ def student_grades(student_id):
             db.session.add(grade)
             flash("Đã thêm điểm!", "success")
         
+        refresh_subject_average(student_id, int(subject_id), semester, school_year)
         db.session.commit()
         return redirect(url_for("student_grades", student_id=student_id))
     
@@ -1728,6 +3806,7 @@ def delete_grade(grade_id):
     if grade:
         student_id = grade.student_id
         db.session.delete(grade)
+        refresh_subject_average(grade.student_id, grade.subject_id, grade.semester, grade.school_year)
         db.session.commit()
         flash("Đã xóa điểm!", "success")
         return redirect(url_for("student_grades", student_id=student_id))
@@ -1749,6 +3828,7 @@ def update_grade_api(grade_id):
             return jsonify({"success": False, "error": "Không tìm thấy điểm"}), 404
         
         grade.score = new_score
+        refresh_subject_average(grade.student_id, grade.subject_id, grade.semester, grade.school_year)
         db.session.commit()
         
         return jsonify({"success": True, "score": new_score})
@@ -1770,46 +3850,15 @@ def student_transcript(student_id):
     semester = int(request.args.get('semester', 1))
     school_year = request.args.get('school_year', '2023-2024')
     
-    subjects = Subject.query.order_by(Subject.name).all()
-    
-    transcript_data = []
-    for subject in subjects:
-        grades = Grade.query.filter_by(
-            student_id=student_id,
-            subject_id=subject.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
-        
-        tx_scores = [g.score for g in grades if g.grade_type == 'TX']
-        gk_scores = [g.score for g in grades if g.grade_type == 'GK']
-        hk_scores = [g.score for g in grades if g.grade_type == 'HK']
-        
-        avg_score = None
-        if tx_scores and gk_scores and hk_scores:
-            avg_tx = sum(tx_scores) / len(tx_scores)
-            avg_gk = sum(gk_scores) / len(gk_scores)
-            avg_hk = sum(hk_scores) / len(hk_scores)
-            avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-        
-        transcript_data.append({
-            'subject': subject,
-            'tx_scores': tx_scores,
-            'gk_scores': gk_scores,
-            'hk_scores': hk_scores,
-            'avg_score': avg_score
-        })
-    
-    valid_averages = [item['avg_score'] for item in transcript_data if item['avg_score'] is not None]
-    gpa = round(sum(valid_averages) / len(valid_averages), 2) if valid_averages else None
+    transcript = build_transcript(student_id, semester, school_year)
     
     return render_template(
         "student_transcript.html",
         student=student,
-        transcript_data=transcript_data,
+        transcript_data=transcript.subjects,
         semester=semester,
         school_year=school_year,
-        gpa=gpa
+        gpa=transcript.gpa
     )
 
 
@@ -1869,37 +3918,7 @@ def parent_report(student_id):
     semester = int(request.args.get('semester', 1))
     school_year = request.args.get('school_year', '2023-2024')
     
-    subjects = Subject.query.order_by(Subject.name).all()
-    transcript_data = []
-    for subject in subjects:
-        grades = Grade.query.filter_by(
-            student_id=student_id,
-            subject_id=subject.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
-        
-        tx_scores = [g.score for g in grades if g.grade_type == 'TX']
-        gk_scores = [g.score for g in grades if g.grade_type == 'GK']
-        hk_scores = [g.score for g in grades if g.grade_type == 'HK']
-        
-        avg_score = None
-        if tx_scores and gk_scores and hk_scores:
-            avg_tx = sum(tx_scores) / len(tx_scores)
-            avg_gk = sum(gk_scores) / len(gk_scores)
-            avg_hk = sum(hk_scores) / len(hk_scores)
-            avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-        
-        transcript_data.append({
-            'subject': subject,
-            'tx_scores': tx_scores,
-            'gk_scores': gk_scores,
-            'hk_scores': hk_scores,
-            'avg_score': avg_score
-        })
-    
-    valid_averages = [item['avg_score'] for item in transcript_data if item['avg_score'] is not None]
-    gpa = round(sum(valid_averages) / len(valid_averages), 2) if valid_averages else None
+    transcript = build_transcript(student_id, semester, school_year)
     
     current_week_cfg = SystemConfig.query.filter_by(key="current_week").first()
     current_week = int(current_week_cfg.value) if current_week_cfg else 1
@@ -1914,8 +3933,8 @@ def parent_report(student_id):
     return render_template(
         "parent_report.html",
         student=student,
-        transcript_data=transcript_data,
-        gpa=gpa,
+        transcript_data=transcript.subjects,
+        gpa=transcript.gpa,
         semester=semester,
         school_year=school_year,
         recent_violations=recent_violations,
@@ -1924,40 +3943,16 @@ def parent_report(student_id):
         now=datetime.datetime.now()
     )
 
-@app.route("/api/generate_parent_report/<int:student_id>", methods=["POST"])
-@login_required
-def generate_parent_report(student_id):
-    """Gọi AI tạo nhận xét tổng hợp cho phụ huynh"""
+def run_parent_report(job_id, params):
+    """Job AI: nhận xét tổng hợp gửi phụ huynh"""
+    student_id = params["student_id"]
     student = db.session.get(Student, student_id)
-    if not student:
-        return jsonify({"error": "Không tìm thấy học sinh"}), 404
-    
-    semester = int(request.json.get('semester', 1))
-    school_year = request.json.get('school_year', '2023-2024')
-    
-    subjects = Subject.query.all()
-    grades_info = []
-    for subject in subjects:
-        grades = Grade.query.filter_by(
-            student_id=student_id,
-            subject_id=subject.id,
-            semester=semester,
-            school_year=school_year
-        ).all()
-        
-        tx_scores = [g.score for g in grades if g.grade_type == 'TX']
-        gk_scores = [g.score for g in grades if g.grade_type == 'GK']
-        hk_scores = [g.score for g in grades if g.grade_type == 'HK']
-        
-        if tx_scores and gk_scores and hk_scores:
-            avg_tx = sum(tx_scores) / len(tx_scores)
-            avg_gk = sum(gk_scores) / len(gk_scores)
-            avg_hk = sum(hk_scores) / len(hk_scores)
-            avg_score = round((avg_tx + avg_gk * 2 + avg_hk * 3) / 6, 2)
-            grades_info.append(f"{subject.name}: {avg_score}")
+    semester = params["semester"]
+    school_year = params["school_year"]
     
-    valid_avg = [float(g.split(': ')[1]) for g in grades_info if g]
-    gpa = round(sum(valid_avg) / len(valid_avg), 2) if valid_avg else 0
+    transcript = build_transcript(student_id, semester, school_year)
+    grades_info = [f"{item.subject.name}: {item.avg_score}" for item in transcript.graded_subjects]
+    gpa = transcript.gpa or 0
     
     violations = Violation.query.filter_by(student_id=student_id)\
         .order_by(Violation.date_committed.desc())\
@@ -1977,65 +3972,169 @@ THÔNG TIN RÈN LUYỆN:
 
 Hãy viết nhận xét xúc tích, chân thành, khích lệ học sinh và đưa ra lời khuyên cụ thể. Không cần xưng hô, viết trực tiếp nội dung."""
     
-    response, error = _call_gemini(prompt)
-    
+    response, error = _call_gemini(
+        prompt, cache_ttl=LLM_TTL_STUDENT_REPORT, bypass_cache=params.get("regenerate", False)
+    )
     if error:
-        return jsonify({"error": error}), 500
+        print(f"Parent Report AI Error: {error}")
+        report = (
+            f"GPA học kỳ {semester}: {gpa}/10. "
+            f"Điểm các môn: {', '.join(grades_info) if grades_info else 'Chưa có điểm'}.\n"
+            f"Điểm rèn luyện hiện tại: {student.current_score}/100, {violation_summary.lower()}.\n"
+            f"{AI_FALLBACK_NOTE}"
+        )
+        return {"report": report, "fallback": True}
+    return {"report": response}
+
+@app.route("/api/generate_parent_report/<int:student_id>", methods=["POST"])
+@login_required
+def generate_parent_report(student_id):
+    """Gọi AI tạo nhận xét tổng hợp cho phụ huynh (gửi "async": true để nhận job_id)"""
+    student = db.session.get(Student, student_id)
+    if not student:
+        return jsonify({"error": "Không tìm thấy học sinh"}), 404
     
-    return jsonify({"report": response})
+    data = request.get_json(silent=True) or {}
+    params = {
+        "student_id": student_id,
+        "semester": int(data.get('semester', 1)),
+        "school_year": data.get('school_year', '2023-2024'),
+        "regenerate": bool(data.get('regenerate'))
+    }
+    return respond_ai_job("parent_report", run_parent_report, params, wait=not data.get("async"))
+
 
+def run_week_rollover(job_id, params):
+    """
+    Job chuyển tuần: tăng số tuần, lưu trữ tuần cũ, reset điểm - tất cả trong một transaction
+    An toàn khi chạy lại/chạy đồng thời: job nào "giành" được tuần (compare-and-set trên
+    current_week) mới lưu trữ và reset, job còn lại không làm gì thêm
+    """
+    from_week = params["from_week"]
+    update_job(job_id, progress=10, message=f"Đang lưu trữ Tuần {from_week}...")
+    
+    # 1. Giành tuần: chỉ tăng số tuần nếu giá trị vẫn là from_week. UPDATE giữ khóa ghi tới khi commit
+    # nên job đồng thời phải chờ và sẽ thấy tuần đã được chuyển
+    week_cfg = SystemConfig.query.filter_by(key="current_week").first()
+    if week_cfg:
+        claimed = SystemConfig.query.filter_by(key="current_week", value=str(from_week))\
+            .update({SystemConfig.value: str(from_week + 1)}, synchronize_session=False)
+    else:
+        db.session.add(SystemConfig(key="current_week", value=str(from_week + 1)))
+        claimed = 1
+    if not claimed:
+        db.session.rollback()
+        week_cfg = SystemConfig.query.filter_by(key="current_week").first()
+        update_job(job_id, message=f"Tuần {from_week} đã được kết thúc trước đó.")
+        return {"from_week": from_week, "to_week": int(week_cfg.value), "already_done": True}
+    
+    # 2. Lưu trữ điểm tuần cũ (trước khi reset, cùng transaction)
+    try:
+        archive_report = save_weekly_archive(from_week, commit=False)
+    except Exception as e:
+        db.session.rollback()
+        raise RuntimeError(f"Không lưu trữ được Tuần {from_week}: {e}")
+    
+    # 3. Reset điểm toàn bộ học sinh về 100
+    db.session.query(Student).update({Student.current_score: 100})
+    
+    # 4. Cập nhật "Dấu vết" tuần ISO để tắt cảnh báo
+    current_iso = get_current_iso_week()
+    last_reset_cfg = SystemConfig.query.filter_by(key="last_reset_week_id").first()
+    if not last_reset_cfg:
+        db.session.add(SystemConfig(key="last_reset_week_id", value=current_iso))
+    else:
+        last_reset_cfg.value = current_iso
+    
+    db.session.commit()
+    invalidate_class_stats()
+    invalidate_global_context()
+    
+    update_job(job_id, message=(
+        f"Đã kết thúc Tuần {from_week}. Hệ thống chuyển sang Tuần {from_week + 1}. "
+        f"Đã lưu trữ {archive_report['rows']} học sinh ({archive_report['seconds']}s)."
+    ))
+    return {
+        "from_week": from_week,
+        "to_week": from_week + 1,
+        "archived_rows": archive_report["rows"],
+        "archive_seconds": archive_report["seconds"],
+        "already_done": False
+    }
 
 @app.route("/admin/reset_week", methods=["POST"])
 @login_required
 def reset_week():
+    """Bắt đầu job chuyển tuần chạy nền, dashboard sẽ theo dõi tiến độ"""
     try:
-        # 1. Lấy tuần hiển thị hiện tại
-        week_cfg = SystemConfig.query.filter_by(key="current_week").first()
-        current_week_num = int(week_cfg.value) if week_cfg else 1
-        
-        # 2. Lưu trữ dữ liệu tuần cũ
-        save_weekly_archive(current_week_num)
-        
-        # 3. Reset điểm toàn bộ học sinh về 100
-        db.session.query(Student).update({Student.current_score: 100})
-        
-        # 4. Tăng số tuần hiển thị lên 1
-        if week_cfg:
-            week_cfg.value = str(current_week_num + 1)
-            
-        # 5. Cập nhật "Dấu vết" tuần ISO để tắt cảnh báo
-        current_iso = get_current_iso_week()
-        last_reset_cfg = SystemConfig.query.filter_by(key="last_reset_week_id").first()
-        if not last_reset_cfg:
-            db.session.add(SystemConfig(key="last_reset_week_id", value=current_iso))
+        job = get_active_job("week_rollover")
+        if job:
+            flash("Hệ thống đang chuyển tuần, vui lòng chờ.", "error")
         else:
-            last_reset_cfg.value = current_iso
-            
-        db.session.commit()
-        flash(f"Đã kết thúc Tuần {current_week_num}. Hệ thống chuyển sang Tuần {current_week_num + 1}.", "success")
-        
+            # Lấy tuần hiển thị hiện tại
+            week_cfg = SystemConfig.query.filter_by(key="current_week").first()
+            current_week_num = int(week_cfg.value) if week_cfg else 1
+            submit_job("week_rollover", run_week_rollover, params={"from_week": current_week_num}, created_by=current_user.id)
+            flash(f"Đang kết thúc Tuần {current_week_num}...", "success")
     except Exception as e:
         db.session.rollback()
         flash(f"Lỗi: {str(e)}", "error")
         
     return redirect(url_for("dashboard"))
+
+@app.route("/api/jobs/<int:job_id>")
+@login_required
+def job_status(job_id):
+    """Trạng thái/tiến độ của một job chạy nền"""
+    job = db.session.get(BackgroundJob, job_id)
+    # Job của giáo viên khác trả 404 như không tồn tại (trừ job toàn hệ thống như chuyển tuần)
+    if not job or (job.job_type not in SHARED_JOB_TYPES and job.created_by != current_user.id):
+        return jsonify({"error": "Không tìm thấy job"}), 404
+    check_job_timeout(job)
+    return jsonify(job_to_dict(job))
 @app.route("/admin/update_week", methods=["POST"])
 def update_week():
     c = SystemConfig.query.filter_by(key="current_week").first()
     if c: c.value = str(request.form["new_week"]); db.session.commit()
+    invalidate_class_stats()
+    invalidate_global_context()
     return redirect(url_for("dashboard"))
+@app.route("/api/cache_stats")
+@login_required
+def cache_stats():
+    """Số lần hit/miss của các cache trong bộ nhớ"""
+    with _global_context_lock:
+        global_context = dict(_global_context_stats)
+    with _ocr_cache_lock:
+        ocr = dict(_ocr_cache_stats, size=len(_ocr_cache))
+    with _llm_cache_lock:
+        llm = dict(_llm_cache_stats, size=len(_llm_cache))
+    lookups = llm["hits"] + llm["misses"]
+    llm["hit_rate"] = round(llm["hits"] / lookups, 3) if lookups else 0.0
+    return jsonify({"global_context": global_context, "ocr": ocr, "llm": llm})
+
+@app.route("/api/ai_status")
+@login_required
+def ai_status():
+    """Trạng thái kết nối Ollama (circuit breaker, số lần gọi/retry/lỗi)"""
+    return jsonify(ollama_client.status())
+
 @app.route("/api/check_duplicate_student", methods=["POST"])
 def check_duplicate_student(): return jsonify([])
 
 def create_database():
     db.create_all()
+    # Database cũ: create_all không thêm cột vào bảng đã có
+    ensure_violation_content_hash()
     if not Teacher.query.first(): db.session.add(Teacher(username="admin", password="admin", full_name="Admin"))
     if not SystemConfig.query.first(): db.session.add(SystemConfig(key="current_week", value="1"))
     if not ViolationType.query.first(): db.session.add(ViolationType(name="Đi muộn", points_deducted=2))
     db.session.commit()
-
-if __name__ == "__main__":
-    with app.app_context(): create_database()
+    seed_violation_weeks()
+    # Database nâng cấp từ bản cũ: dựng bảng SubjectAverage từ điểm đã có (nếu không GPA/học bạ sẽ trống)
+    if not db.session.query(SubjectAverage.id).first() and db.session.query(Grade.id).first():
+        rebuild_subject_averages()
+    ensure_student_search_index()
 
 @app.route("/delete_violation/<int:violation_id>", methods=["POST"])
 @login_required
@@ -2053,9 +4152,12 @@ def delete_violation(violation_id):
             if student.current_score > 100:
                 student.current_score = 100
         
-        # 3. Xóa vi phạm
+        # 3. Xóa vi phạm (và tuần khỏi dropdown nếu không còn vi phạm nào)
         db.session.delete(violation)
+        db.session.flush()
+        prune_violation_weeks([violation.week_number])
         db.session.commit()
+        invalidate_class_stats(classes=[student.student_class] if student else None)
         
         flash(f"Đã xóa vi phạm và khôi phục {violation.points_deducted} điểm cho học sinh.", "success")
         
@@ -2083,53 +4185,60 @@ def import_students():
             return redirect(request.url)
 
         try:
-            # Đọc file Excel
-            df = pd.read_excel(file)
-            # Chuẩn hóa tên cột về chữ thường để dễ tìm
-            df.columns = [str(c).strip().lower() for c in df.columns]
+            # Đọc file Excel theo từng lô (openpyxl read-only)
+            frames = iter_excel_frames(file)
+            first = next(frames, None)
+            columns = [str(c).strip().lower() for c in first.columns] if first is not None else []
             
             preview_data = []
+            processed_rows = 0
+            class_counts = {}
             
             # Tìm cột Họ tên và Lớp (chấp nhận: "họ tên", "tên", "họ và tên"...)
-            name_col = next((c for c in df.columns if "tên" in c or "name" in c), None)
-            class_col = next((c for c in df.columns if "lớp" in c or "class" in c), None)
+            name_col = next((i for i, c in enumerate(columns) if "tên" in c or "name" in c), None)
+            class_col = next((i for i, c in enumerate(columns) if "lớp" in c or "class" in c), None)
             
-            if not name_col or not class_col:
+            if name_col is None or class_col is None:
                 flash("File Excel cần có cột 'Họ tên' và 'Lớp'", "error")
                 return redirect(request.url)
 
             # Lặp qua từng dòng trong Excel
-            for index, row in df.iterrows():
-                name = str(row[name_col]).strip()
-                s_class = str(row[class_col]).strip()
+            for df in itertools.chain([first], frames):
+                processed_rows += len(df)
+                for index, name, s_class in zip(df.index, df.iloc[:, name_col], df.iloc[:, class_col]):
+                    name = str(name).strip()
+                    s_class = str(s_class).strip()
                 
-                # Bỏ qua dòng trống
-                if not name or name.lower() == 'nan': continue
+                    # Bỏ qua dòng trống
+                    if not name or name.lower() in ('nan', 'none'): continue
 
-                # --- LOGIC SINH MÃ: [KHÓA] [CHUYÊN] - 001[STT] ---
+                    # --- LOGIC SINH MÃ: [KHÓA] [CHUYÊN] - 001[STT] ---
                 
-                # 1. Lấy phần Chuyên (VD: "12 Tin" -> "TIN")
-                class_unsign = unidecode.unidecode(s_class).upper() # 12 TIN
-                # Chỉ giữ lại chữ cái A-Z, bỏ số và dấu cách
-                specialization = re.sub(r'[^A-Z]', '', class_unsign) 
+                    # 1. Lấy phần Chuyên (VD: "12 Tin" -> "TIN")
+                    class_unsign = unidecode.unidecode(s_class).upper() # 12 TIN
+                    # Chỉ giữ lại chữ cái A-Z, bỏ số và dấu cách
+                    specialization = re.sub(r'[^A-Z]', '', class_unsign) 
                 
-                # 2. Tính số thứ tự (STT)
-                # Đếm xem trong DB lớp này đã có bao nhiêu bạn rồi để nối tiếp
-                count_in_db = Student.query.filter_by(student_class=s_class).count()
-                # STT = Số lượng trong DB + Số thứ tự trong file Excel (index bắt đầu từ 0 nên +1)
-                sequence = count_in_db + index + 1
+                    # 2. Tính số thứ tự (STT)
+                    # Đếm xem trong DB lớp này đã có bao nhiêu bạn rồi để nối tiếp
+                    if s_class not in class_counts:
+                        class_counts[s_class] = Student.query.filter_by(student_class=s_class).count()
+                    count_in_db = class_counts[s_class]
+                    # STT = Số lượng trong DB + Số thứ tự trong file Excel (index bắt đầu từ 0 nên +1)
+                    sequence = count_in_db + index + 1
                 
-                # 3. Ghép mã
-                # {sequence:03d} nghĩa là số 6 sẽ thành 006
-                auto_code = f"{course_code} {specialization} - 001{sequence:03d}"
+                    # 3. Ghép mã
+                    # {sequence:03d} nghĩa là số 6 sẽ thành 006
+                    auto_code = f"{course_code} {specialization} - 001{sequence:03d}"
                 
-                preview_data.append({
-                    "name": name,
-                    "class": s_class,
-                    "generated_code": auto_code
-                })
+                    preview_data.append({
+                        "name": name,
+                        "class": s_class,
+                        "generated_code": auto_code
+                    })
             
             # Chuyển sang trang xác nhận
+            flash(f"Đã đọc {processed_rows} dòng, {len(preview_data)} học sinh hợp lệ", "success")
             return render_template("confirm_import.html", students=preview_data)
 
         except Exception as e:
@@ -2165,6 +4274,9 @@ def save_imported_students():
             count += 1
             
         db.session.commit()
+        invalidate_class_stats(classes=set(classes))
+        invalidate_student_index()
+        invalidate_global_context()
         flash(f"Đã nhập thành công {count} học sinh!", "success")
         return redirect(url_for('manage_students'))
         
@@ -2172,6 +4284,8 @@ def save_imported_students():
         db.session.rollback()
         flash(f"Lỗi khi lưu: {str(e)}", "error")
         return redirect(url_for('import_students'))
-    
-app.run(debug=True)
- 
+
+
+if __name__ == "__main__":
+    with app.app_context(): create_database()
+    app.run(debug=True)
@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Migration script thêm cột content_hash (chống import trùng) cho bảng Violation hiện có
+App tự làm bước này khi khởi động (create_database); chạy script trước khi khởi động
+nếu bảng Violation rất lớn, hoặc để gán lại hash cho các vi phạm còn thiếu
+Nếu dữ liệu cũ đã có bản ghi trùng thì chỉ bản ghi đầu tiên được gán hash
+"""
+
+from app import app, db, ensure_violation_content_hash
+
+def migrate():
+    with app.app_context():
+        print("🔄 Đang thêm cột content_hash cho bảng Violation...")
+        try:
+            assigned = ensure_violation_content_hash(rehash_missing=True)
+            print("✅ Migration hoàn tất!")
+            print(f"📊 Đã gán hash cho {assigned} vi phạm.")
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Lỗi migration: {e}")
+            return False
+    return True
+
+if __name__ == "__main__":
+    migrate()
@@ -48,9 +48,17 @@ class Violation(db.Model):
     points_deducted = db.Column(db.Integer, nullable=False)
     date_committed = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     week_number = db.Column(db.Integer, default=1)
+    # Hash nội dung (student_id, loại, thời điểm, điểm trừ) để import không tạo bản ghi trùng
+    content_hash = db.Column(db.String(64), nullable=True, unique=True, index=True)
     student = db.relationship('Student', backref=db.backref('violations', lazy=True))
 
 
+class ViolationWeek(db.Model):
+    """Các tuần đã có vi phạm (cho dropdown chọn tuần, tránh DISTINCT trên bảng Violation)"""
+    week_number = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+
 class WeeklyArchive(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     week_number = db.Column(db.Integer, nullable=False)
@@ -88,6 +96,29 @@ class Grade(db.Model):
     subject = db.relationship('Subject', backref=db.backref('grades', lazy=True, cascade='all, delete-orphan'))
 
 
+class SubjectAverage(db.Model):
+    """Bảng tổng hợp điểm theo môn/học kỳ, cập nhật cùng transaction khi ghi Grade"""
+    id = db.Column(db.Integer, primary_key=True)
+    student_id = db.Column(db.Integer, db.ForeignKey('student.id'), nullable=False)
+    subject_id = db.Column(db.Integer, db.ForeignKey('subject.id'), nullable=False)
+    semester = db.Column(db.Integer, nullable=False)
+    school_year = db.Column(db.String(20))
+    tx_sum = db.Column(db.Float, default=0)
+    tx_count = db.Column(db.Integer, default=0)
+    gk_sum = db.Column(db.Float, default=0)
+    gk_count = db.Column(db.Integer, default=0)
+    hk_sum = db.Column(db.Float, default=0)
+    hk_count = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+    student = db.relationship('Student', backref=db.backref('subject_averages', lazy=True, cascade='all, delete-orphan'))
+    subject = db.relationship('Subject', backref=db.backref('subject_averages', lazy=True, cascade='all, delete-orphan'))
+
+    __table_args__ = (
+        db.UniqueConstraint('student_id', 'subject_id', 'semester', 'school_year', name='uq_subject_average_key'),
+        db.Index('ix_subject_average_term', 'student_id', 'semester', 'school_year'),
+    )
+
+
 class ChatConversation(db.Model):
     """Model lưu trữ lịch sử hội thoại chatbot với context awareness"""
     id = db.Column(db.Integer, primary_key=True)
@@ -98,4 +129,38 @@ class ChatConversation(db.Model):
     context_data = db.Column(db.Text, nullable=True)  # JSON metadata (student_id, etc.)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
     
-    teacher = db.relationship('Teacher', backref=db.backref('chat_history', lazy=True))
\ No newline at end of file
+    teacher = db.relationship('Teacher', backref=db.backref('chat_history', lazy=True))
+
+class BackgroundJob(db.Model):
+    """Tác vụ chạy nền (chuyển tuần, ...) với trạng thái lưu trong CSDL để theo dõi tiến độ"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending/running/done/failed
+    progress = db.Column(db.Integer, default=0)  # 0 - 100
+    processed_rows = db.Column(db.Integer, default=0)  # Số dòng đã xử lý (job import)
+    error_count = db.Column(db.Integer, default=0)
+    message = db.Column(db.String(255))
+    params = db.Column(db.Text, nullable=True)  # JSON
+    result = db.Column(db.Text, nullable=True)  # JSON
+    error = db.Column(db.Text, nullable=True)
+    created_by = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class OcrCache(db.Model):
+    """Kết quả OCR đã parse (JSON), khóa = hash nội dung ảnh + phiên bản prompt/model"""
+    key = db.Column(db.String(100), primary_key=True)
+    result = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
+
+class LlmCache(db.Model):
+    """Response text của Ollama đã cache, khóa = hash(model, is_json, prompt)"""
+    key = db.Column(db.String(64), primary_key=True)
+    model = db.Column(db.String(100), nullable=False)
+    response = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_used_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, index=True)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Script dựng lại bảng SubjectAverage (điểm tổng hợp theo môn) từ bảng Grade
+Chạy lần đầu sau khi nâng cấp, hoặc định kỳ để kiểm tra sai lệch (drift)
+
+    python rebuild_subject_averages.py          # kiểm tra + dựng lại
+    python rebuild_subject_averages.py --check  # chỉ kiểm tra, không ghi
+"""
+
+import sys
+
+from app import app, db, rebuild_subject_averages
+
+def rebuild(check_only=False):
+    with app.app_context():
+        # Tạo bảng mới nếu database cũ chưa có
+        db.create_all()
+        print("🔄 Đang đối chiếu SubjectAverage với bảng Grade...")
+        try:
+            report = rebuild_subject_averages(check_only=check_only)
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Lỗi: {e}")
+            return False
+
+        print(f"📊 Số dòng tổng hợp: {report['rows']}")
+        print(f"   - Thiếu: {report['missing']}")
+        print(f"   - Thừa: {report['stale']}")
+        print(f"   - Sai lệch: {report['drifted']}")
+        if check_only:
+            if report['missing'] or report['stale'] or report['drifted']:
+                print("⚠️ Phát hiện sai lệch. Chạy lại không có --check để dựng lại bảng.")
+            else:
+                print("✅ Bảng SubjectAverage khớp với dữ liệu điểm.")
+        else:
+            print("✅ Đã dựng lại bảng SubjectAverage!")
+    return True
+
+if __name__ == "__main__":
+    rebuild(check_only="--check" in sys.argv)